@@ -0,0 +1,5 @@
+# coding: utf-8
+""" Benchmarks of Librorum, run them from the repository root, e.g.
+
+    python -m benchmarks.run --output results.json
+"""
@@ -0,0 +1,65 @@
+# coding: utf-8
+""" Seeded generator of a synthetic catalogue of Chinese, pinyin and Latin terms """
+import random
+
+from pypinyin import lazy_pinyin
+
+
+HANZI_WORDS = [
+    u'北京', u'上海', u'成都', u'广州', u'深圳', u'杭州', u'南京', u'武汉', u'西安', u'重庆',
+    u'清华', u'北大', u'百度', u'腾讯', u'阿里', u'华为', u'中国', u'人民', u'国际', u'东方',
+    u'大学', u'学院', u'医学部', u'研究院', u'中心', u'医院', u'银行', u'公司', u'集团', u'有限',
+    u'投资', u'金融', u'科技', u'网络', u'信息', u'技术', u'软件', u'数据', u'电子', u'商务',
+    u'教育', u'文化', u'传媒', u'管理', u'发展', u'工业', u'机构', u'青鸟', u'河岸', u'实验室',
+]
+LATIN_WORDS = [
+    u'Univ', u'Tech', u'Labs', u'Group', u'Capital', u'Peiking', u'QsingHua', u'Data', u'Cloud',
+    u'Media', u'Bank', u'Soft', u'Net', u'China', u'Global', u'Beijing', u'Shanghai', u'Baidu',
+]
+
+
+def hanzi_term(rand):
+    return u''.join(rand.choice(HANZI_WORDS) for _ in range(rand.choice((1, 2, 2, 3, 3, 4))))
+
+
+def mixed_term(rand):
+    """ Like u'QsingHua大学' """
+    return rand.choice(LATIN_WORDS) + hanzi_term(rand)
+
+
+def latin_term(rand):
+    """ Like u'Peiking Univ' """
+    return u' '.join(rand.choice(LATIN_WORDS) for _ in range(rand.choice((1, 2, 2, 3))))
+
+
+def pinyin_term(rand):
+    return u' '.join(u''.join(lazy_pinyin(rand.choice(HANZI_WORDS))) for _ in range(rand.choice((1, 2, 3))))
+
+
+KINDS = [(0.6, hanzi_term), (0.15, mixed_term), (0.15, latin_term), (0.1, pinyin_term)]
+
+
+def generate(count, seed=0):
+    """ Yield `count` items like the ones of the test fixtures: a uid, a term and
+    the typed structure fields `t` (a flag) and `n` (a skewed small number) """
+    rand = random.Random(seed)
+    for uid in range(1, count + 1):
+        point = rand.random()
+        for weight, kind in KINDS:
+            point -= weight
+            if point < 0:
+                break
+        yield dict(uid=uid, term=kind(rand), t=int(rand.random() < 0.3),
+                   n=min(int(rand.expovariate(0.3)), 20))
+
+
+def queries(items, count, seed=0, length=None):
+    """ Typeahead queries: prefixes of the pinyin or the term of random items,
+    `length` characters long when given """
+    rand = random.Random(seed)
+    for _ in range(count):
+        term = rand.choice(items)['term'].lower()
+        if rand.random() < 0.5:
+            term = u''.join(lazy_pinyin(term))
+        size = length or rand.randint(1, 12)
+        yield term[:size]
@@ -0,0 +1,89 @@
+# coding: utf-8
+""" Measure the memory/recall trade-off of the bounded prefix indexing policies.
+
+The index of a synthetic corpus is built in process, from the postings Librorum
+would write, so no Redis server is needed. Memory is counted in postings (zset
+members), recall is the recall@10 of every policy against the unbounded index.
+
+    python -m benchmarks.prefix_policy --items 20000
+"""
+import argparse
+from collections import defaultdict
+
+from librorum import Librorum
+
+from .corpus import generate, queries
+
+
+POLICIES = [
+    dict(),
+    dict(max_prefix=8),
+    dict(max_prefix=6),
+    dict(max_prefix=4),
+    dict(max_prefix=6, short_prefix=1, top_k=1000),
+    dict(max_prefix=6, short_prefix=2, top_k=1000),
+    dict(max_prefix=4, short_prefix=2, top_k=200),
+]
+
+
+def build(lib, items):
+    """ The index of `items`, as {key suffix: {uid: score}} """
+    index = defaultdict(dict)
+    for item in items:
+        for key, score in lib.postings(item['term']).items():
+            index[lib._suffix(key)][str(item['uid'])] = score
+    top_k = lib.config['top_k']
+    if top_k:
+        for suffix, members in index.items():
+            if len(suffix) <= lib.config['short_prefix'] and len(members) > top_k:
+                kept = sorted(members.items(), key=lambda m: (m[1], m[0]))[:top_k]
+                index[suffix] = dict(kept)
+    return index
+
+
+def retrieve(lib, index, query, limit=10):
+    """ What ZINTERSTORE plus ZRANGE would return for `query` """
+    words, _, _, _ = lib._query(lib.analyzer.to_pinyin(query), {})
+    postings = [index.get(word, {}) for word in words]
+    if not postings:
+        return []
+    postings.sort(key=len)
+    scores = dict(postings[0])
+    for members in postings[1:]:
+        scores = dict((uid, score + members[uid]) for uid, score in scores.items() if uid in members)
+    return [uid for uid, _ in sorted(scores.items(), key=lambda m: (m[1], m[0]))[:limit]]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--items', type=int, default=20000)
+    parser.add_argument('--queries', type=int, default=2000)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    items = list(generate(args.items, args.seed))
+    sample = list(queries(items, args.queries, args.seed))
+
+    baseline_lib = Librorum(None)
+    baseline = build(baseline_lib, items)
+    truth = [retrieve(baseline_lib, baseline, query) for query in sample]
+    baseline_postings = sum(map(len, baseline.values()))
+
+    print('| max_prefix | short_prefix | top_k | keys | postings | memory | recall@10 |')
+    print('|---|---|---|---|---|---|---|')
+    for policy in POLICIES:
+        lib = Librorum(None, **policy)
+        index = build(lib, items)
+        postings = sum(map(len, index.values()))
+        hits = total = 0
+        for query, expected in zip(sample, truth):
+            found = set(retrieve(lib, index, query))
+            hits += len(found.intersection(expected))
+            total += len(expected)
+        print('| %s | %s | %s | %d | %d | %.0f%% | %.3f |' % (
+            policy.get('max_prefix', '-'), policy.get('short_prefix', '-'), policy.get('top_k', '-'),
+            len(index), postings, 100.0 * postings / baseline_postings, float(hits) / total if total else 1))
+
+
+if __name__ == '__main__':
+    main()
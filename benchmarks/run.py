@@ -0,0 +1,138 @@
+# coding: utf-8
+""" Measure indexing throughput, query latency, storage and tokenizer cost on a
+synthetic corpus, and report them as JSON so runs can be compared across commits.
+
+    python -m benchmarks.run --output before.json
+    python -m benchmarks.run --backend redis --url redis://localhost:6379/15
+"""
+import argparse
+import json
+import platform
+import subprocess
+import sys
+import time
+
+from librorum import Librorum
+from librorum.backends import MemoryBackend
+from librorum.engine import Analyzer
+
+from .corpus import generate, queries
+
+
+STRUCTURE = dict(t=int, n=int)
+PREFIX_LENGTHS = (1, 2, 3, 4, 6, 8)
+
+
+def percentile(timings, p):
+    timings = sorted(timings)
+    return timings[min(len(timings) - 1, int(len(timings) * p / 100.0))]
+
+
+def latency(timings):
+    """ Percentiles of `timings` given in seconds, in milliseconds """
+    return dict(('p%d' % p, round(percentile(timings, p) * 1000, 4)) for p in (50, 95, 99))
+
+
+def connect(args):
+    if args.backend == 'memory':
+        return MemoryBackend()
+    import redis
+    return redis.StrictRedis.from_url(args.url)
+
+
+def bench_indexing(lib, items):
+    lib.flush()
+    lib.analyzer.segments.clear()
+    start = time.time()
+    for item in items:
+        lib.add_item(item)
+    add_item = time.time() - start
+
+    lib.flush()
+    lib.analyzer.segments.clear()
+    start = time.time()
+    lib.add_items(items)
+    add_items = time.time() - start
+    return dict(add_item=len(items) / add_item, add_items=len(items) / add_items)
+
+
+def bench_queries(lib, items, count, seed):
+    results = {}
+    for length in PREFIX_LENGTHS:
+        sample = list(queries(items, count, seed, length))
+        search, retrieve = [], []
+        for query in sample:
+            start = time.time()
+            lib.retrieve(lib.analyzer.to_pinyin(query), limit=10)
+            retrieve.append(time.time() - start)
+            start = time.time()
+            lib.search(query, limit=10)
+            search.append(time.time() - start)
+        results[str(length)] = dict(search=latency(search), retrieve=latency(retrieve))
+    return results
+
+
+def bench_storage(lib, items, sample=200):
+    """ Keys per item, and bytes per item extrapolated from MEMORY USAGE of a sample of keys """
+    keys = list(lib.redis.scan_iter(match='%s_*' % lib.namespace, count=1000))
+    storage = dict(keys=len(keys), keys_per_item=float(len(keys)) / len(items), bytes_per_item=None)
+    if hasattr(lib.redis, 'memory_usage') and keys:
+        step = max(1, len(keys) // sample)
+        sampled = keys[::step]
+        used = sum(lib.redis.memory_usage(key) or 0 for key in sampled)
+        storage['bytes_per_item'] = float(used) * len(keys) / len(sampled) / len(items)
+    return storage
+
+
+def bench_tokenizer(items):
+    analyzer = Analyzer(cache_size=0)
+    terms = [item['term'].lower() for item in items]
+    start = time.time()
+    for term in terms:
+        analyzer.get_indexes(term)
+    return dict(seconds_per_term=(time.time() - start) / len(terms))
+
+
+def commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD']).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--backend', choices=('memory', 'redis'), default='memory')
+    parser.add_argument('--url', default='redis://localhost:6379/15')
+    parser.add_argument('--items', type=int, default=10000)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write the JSON report to this file instead of stdout')
+    args = parser.parse_args()
+
+    items = list(generate(args.items, args.seed))
+    lib = Librorum(connect(args), engine_name='bench', structure=STRUCTURE)
+    lib.analyzer.get_indexes(u'预热')
+
+    report = dict(
+        commit=commit(),
+        timestamp=time.time(),
+        python=platform.python_version(),
+        config=vars(args),
+        tokenizer=bench_tokenizer(items),
+        indexing=bench_indexing(lib, items),
+    )
+    report['storage'] = bench_storage(lib, items)
+    report['queries'] = bench_queries(lib, items, args.queries, args.seed)
+    lib.flush()
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        sys.stdout.write(output + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+# coding: utf-8
+""" Compare the latency of the multi-call search with the scripted one.
+
+    python -m benchmarks.search_latency --url redis://localhost:6379/15
+"""
+import argparse
+import time
+
+import redis
+
+from librorum import Librorum
+
+from .corpus import generate, queries
+from .run import percentile
+
+
+def measure(lib, sample, rounds, **kwargs):
+    timings = []
+    for _ in range(rounds):
+        for query in sample:
+            start = time.time()
+            lib.search(query, **kwargs)
+            timings.append((time.time() - start) * 1000)
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--url', default='redis://localhost:6379/15')
+    parser.add_argument('--items', type=int, default=10000)
+    parser.add_argument('--rounds', type=int, default=50)
+    parser.add_argument('--limit', type=int, default=10)
+    args = parser.parse_args()
+
+    conn = redis.StrictRedis.from_url(args.url)
+    items = list(generate(args.items))
+    sample = list(queries(items, 20))
+    structure = dict(t=int, n=int)
+
+    lib = Librorum(conn, engine_name='bench', structure=structure)
+    lib.flush()
+    lib.add_items(items)
+    scripted = Librorum(conn, engine_name='bench', structure=structure, scripted=True)
+
+    for name, engine in (('multi-call', lib), ('scripted', scripted)):
+        measure(engine, sample, 5, limit=args.limit)
+        timings = measure(engine, sample, args.rounds, limit=args.limit)
+        print('%-10s p50 %.3fms  p95 %.3fms  p99 %.3fms' % (
+            name, percentile(timings, 50), percentile(timings, 95), percentile(timings, 99)))
+
+    lib.flush()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+# coding: utf-8
+""" Measure the cold start of a worker process: the import of librorum, the boot of a
+tokenizer worker, and the latency of the first query with and without warmup() and
+a prebuilt dictionary (see librorum.dictionary). Every case runs in a fresh
+interpreter, the report is JSON.
+
+    python -m benchmarks.startup --repeat 5
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+from librorum.dictionary import build
+
+from .run import percentile
+
+
+CASES = dict(
+    import_librorum="""
+start = time.time()
+import librorum
+report(import_librorum=time.time() - start)
+""",
+    first_query="""
+import librorum
+lib = librorum.Librorum(None, dictionary=DICTIONARY)
+start = time.time()
+lib.analyzer.get_indexes(u'北京大学')
+lib.analyzer.to_pinyin(u'清华')
+report(first_query=time.time() - start)
+""",
+    warmup="""
+import librorum
+lib = librorum.Librorum(None, dictionary=DICTIONARY)
+start = time.time()
+lib.warmup()
+warmup = time.time() - start
+start = time.time()
+lib.analyzer.get_indexes(u'北京大学')
+lib.analyzer.to_pinyin(u'清华')
+report(warmup=warmup, first_query=time.time() - start)
+""",
+    worker_boot="""
+from librorum.engine import init_tokenizer
+start = time.time()
+init_tokenizer(dictionary=DICTIONARY)
+report(worker_boot=time.time() - start)
+""",
+)
+
+PRELUDE = """
+import json, sys, time
+DICTIONARY = %r
+def report(**timings):
+    sys.stdout.write(json.dumps(timings))
+"""
+
+
+def measure(case, dictionary):
+    """ The timings of `case` in a fresh interpreter, in seconds """
+    script = PRELUDE % dictionary + CASES[case]
+    output = subprocess.check_output([sys.executable, '-c', script], stderr=subprocess.DEVNULL)
+    return json.loads(output.decode())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--userdict', action='append', default=[], help='user dictionary, can be repeated')
+    args = parser.parse_args()
+
+    fd, dictionary = tempfile.mkstemp(suffix='.dict')
+    os.close(fd)
+    try:
+        build(dictionary, userdicts=args.userdict)
+        report = {}
+        for name, path in (('jieba', None), ('prebuilt', dictionary)):
+            results = report[name] = {}
+            for case in sorted(CASES):
+                runs = [measure(case, path) for _ in range(args.repeat)]
+                for key in runs[0]:
+                    results['%s.%s' % (case, key) if key != case else case] = \
+                        round(percentile([run[key] for run in runs], 50) * 1000, 2)
+    finally:
+        os.remove(dictionary)
+
+    output = dict(unit='ms', median_of=args.repeat, startup=report)
+    sys.stdout.write(json.dumps(output, indent=2, sort_keys=True) + '\n')
+
+
+if __name__ == '__main__':
+    main()
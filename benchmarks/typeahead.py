@@ -0,0 +1,74 @@
+# coding: utf-8
+""" Measure the latency of every keystroke of typeahead sessions: each query of the
+sample is typed one character at a time, and every prefix is searched by search()
+without and with cached results, and by typeahead(), which narrows the result of
+the previous keystroke. Sessions run without filters, and with a structure and a
+range filter. The report is JSON, in milliseconds, by keystroke.
+
+    python -m benchmarks.typeahead --backend redis --url redis://localhost:6379/15
+"""
+import argparse
+import json
+import sys
+import time
+
+from librorum import Librorum
+
+from .corpus import generate, queries
+from .run import STRUCTURE, connect, latency
+
+
+FILTERS = dict(plain={}, filtered=dict(t=1, n__gte=5))
+
+
+def measure(lib, method, sessions, limit, filters):
+    """ Timings of `method` of `lib` for every keystroke of `sessions`, by keystroke """
+    lib.redis.incr(lib.generation)
+    timings = {}
+    for query in sessions:
+        search = getattr(lib, method)
+        for length in range(1, len(query) + 1):
+            start = time.time()
+            search(query[:length], limit=limit, **filters)
+            timings.setdefault(length, []).append(time.time() - start)
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--backend', choices=('memory', 'redis'), default='memory')
+    parser.add_argument('--url', default='redis://localhost:6379/15')
+    parser.add_argument('--items', type=int, default=20000)
+    parser.add_argument('--sessions', type=int, default=200)
+    parser.add_argument('--length', type=int, default=8, help='characters typed per session')
+    parser.add_argument('--limit', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    conn = connect(args)
+    items = list(generate(args.items, args.seed))
+    sessions = list(queries(items, args.sessions, args.seed + 1, args.length))
+
+    lib = Librorum(conn, engine_name='bench_typeahead', structure=STRUCTURE)
+    lib.flush()
+    lib.add_items(items)
+    lib.warmup()
+    cached = Librorum(conn, engine_name='bench_typeahead', structure=STRUCTURE, cached=True)
+
+    report = {}
+    for case, filters in FILTERS.items():
+        report[case] = {}
+        for name, engine, method in (('search', lib, 'search'), ('cached', cached, 'search'),
+                                     ('typeahead', lib, 'typeahead')):
+            timings = measure(engine, method, sessions, args.limit, filters)
+            results = report[case][name] = dict((str(length), latency(values))
+                                                for length, values in sorted(timings.items()))
+            results['all'] = latency([value for values in timings.values() for value in values])
+    lib.flush()
+
+    output = dict(backend=args.backend, items=args.items, sessions=args.sessions, keystrokes=report)
+    sys.stdout.write(json.dumps(output, indent=2, sort_keys=True) + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,5 @@
 # coding: utf-8
-from engine import Librorum
+from .engine import Librorum
 
 
 __all__ = ['Librorum']
@@ -0,0 +1,137 @@
+# coding: utf-8
+""" Librorum command line.
+
+    python -m librorum load items.jsonl --engine NAME --structure t:int --structure n:int
+    python -m librorum build items.jsonl index.snapshot --structure t:int --structure n:int
+    python -m librorum restore index.snapshot --engine NAME --versioned
+    python -m librorum stats --engine NAME --versioned
+"""
+import argparse
+import itertools
+import json
+import sys
+
+from .engine import Librorum
+from .loader import load, read_batches
+from . import snapshot
+
+
+TYPES = dict(int=int, float=float, str=str)
+
+
+def structure_field(value):
+    """ A --structure argument, `<field>:<type>` with the type among int, float and str """
+    field, _, kind = value.partition(':')
+    if kind not in TYPES:
+        raise argparse.ArgumentTypeError('%r is not <field>:<%s>' % (value, '|'.join(sorted(TYPES))))
+    return field, TYPES[kind]
+
+
+def connect(url):
+    import redis
+    return redis.StrictRedis.from_url(url)
+
+
+def config(args):
+    """ The engine config given by the options of the `config` parser """
+    return dict(structure=dict(args.structure), codec=args.codec, max_prefix=args.max_prefix,
+                dictionary=args.dictionary)
+
+
+def engine(args):
+    return Librorum(connect(args.url), engine_name=args.engine, versioned=args.versioned, **config(args))
+
+
+def progress(stats):
+    sys.stderr.write('\r%(items)d items, %(rate).0f items/s, offset %(offset)d' % stats)
+    sys.stderr.flush()
+
+
+def command_load(args):
+    stats = load(engine(args), args.path, batch_size=args.batch_size, workers=args.workers,
+                 queue_size=args.queue_size, checkpoint=args.checkpoint,
+                 checkpoint_every=args.checkpoint_every, resume=not args.restart,
+                 callback=None if args.quiet else progress)
+    if not args.quiet:
+        sys.stderr.write('\n')
+    sys.stdout.write(json.dumps(stats, sort_keys=True) + '\n')
+
+
+def command_build(args):
+    items = itertools.chain.from_iterable(batch for batch, _ in read_batches(args.path, args.batch_size))
+    stats = snapshot.build(items, args.snapshot, args.batch_size, args.workers, **config(args))
+    sys.stdout.write(json.dumps(stats, sort_keys=True) + '\n')
+
+
+def command_restore(args):
+    lib = engine(args)
+    target = lib.rebuild() if args.versioned else lib
+    stats = snapshot.restore(target, args.snapshot)
+    if args.versioned:
+        lib.publish(target)
+        stats['version'] = target.config['version']
+    sys.stdout.write(json.dumps(stats, sort_keys=True) + '\n')
+
+
+def command_stats(args):
+    stats = engine(args).stats(sample=args.sample, top=args.top, count=args.count)
+    sys.stdout.write(json.dumps(stats, indent=2, sort_keys=True) + '\n')
+
+
+def parser():
+    parser = argparse.ArgumentParser(prog='python -m librorum', description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    options = argparse.ArgumentParser(add_help=False)
+    options.add_argument('--structure', type=structure_field, action='append', default=[],
+                         help='structure field as <field>:<int|float|str>, can be repeated')
+    options.add_argument('--codec', default='json', help='document codec')
+    options.add_argument('--max-prefix', type=int, help='longest indexed prefix')
+    options.add_argument('--dictionary', help='prebuilt jieba dictionary, see librorum.dictionary')
+
+    connection = argparse.ArgumentParser(add_help=False, parents=[options])
+    connection.add_argument('--engine', required=True, help='engine name')
+    connection.add_argument('--url', default='redis://localhost:6379/0')
+    connection.add_argument('--versioned', action='store_true', help='versioned engine')
+
+    command = subparsers.add_parser('load', parents=[connection], help='load a JSON lines file of items')
+    command.add_argument('path')
+    command.add_argument('--batch-size', type=int, default=1000)
+    command.add_argument('--workers', type=int, default=1, help='tokenizer processes')
+    command.add_argument('--queue-size', type=int, default=4, help='batches buffered between the stages')
+    command.add_argument('--checkpoint', help='checkpoint file, <path>.checkpoint by default')
+    command.add_argument('--checkpoint-every', type=int, default=10, help='batches between checkpoints')
+    command.add_argument('--restart', action='store_true', help='ignore the checkpoint')
+    command.add_argument('--quiet', action='store_true')
+    command.set_defaults(func=command_load)
+
+    command = subparsers.add_parser('build', parents=[options],
+                                    help='index a JSON lines file of items offline, into a snapshot')
+    command.add_argument('path')
+    command.add_argument('snapshot')
+    command.add_argument('--batch-size', type=int, default=1000)
+    command.add_argument('--workers', type=int, default=1, help='tokenizer processes')
+    command.set_defaults(func=command_build)
+
+    command = subparsers.add_parser('restore', parents=[connection],
+                                    help='restore a snapshot, to a new published version if --versioned')
+    command.add_argument('snapshot')
+    command.set_defaults(func=command_restore)
+
+    command = subparsers.add_parser('stats', parents=[connection],
+                                    help='key counts, cardinalities and memory of the index')
+    command.add_argument('--sample', type=int, default=20, help='keys measured by MEMORY USAGE per key class')
+    command.add_argument('--top', type=int, default=10, help='largest posting lists and leaked keys listed')
+    command.add_argument('--count', type=int, default=1000, help='keys per SCAN step')
+    command.set_defaults(func=command_stats)
+    return parser
+
+
+def main(argv=None):
+    args = parser().parse_args(argv)
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,193 @@
+# coding: utf-8
+import asyncio
+import contextvars
+import functools
+import time
+
+from .engine import BaseLibrorum, SEARCH_SCRIPT, TEMP_TTL, chunks, query_args
+
+
+def pinned(method):
+    """ Same as librorum.engine.pinned for coroutines, the alias is refreshed first """
+    @functools.wraps(method)
+    async def call(self, *args, **kwargs):
+        if not self.config['versioned'] or self._pinned.get() is not None:
+            return await method(self, *args, **kwargs)
+        await self._resolve()
+        token = self._pinned.set(self.namespace)
+        try:
+            return await method(self, *args, **kwargs)
+        finally:
+            self._pinned.reset(token)
+    return call
+
+
+class AsyncLibrorum(BaseLibrorum):
+    """ Librorum for asyncio applications, on top of a `redis.asyncio` client.
+
+    It shares the key layout of Librorum through BaseLibrorum, so both can
+    serve the same index. Maintenance (rebuild, publish, sweep, ...) is only
+    done by Librorum on a synchronous client.
+    Tokenization runs in `executor` (the loop default when None) so that jieba
+    and pypinyin never block the event loop. A `metrics` sink only receives
+    the tokenizer timings, round-trips are not counted.
+    """
+
+    def __init__(self, redis_conn, executor=None, **kwargs):
+        super(AsyncLibrorum, self).__init__(redis_conn, **kwargs)
+        self.redis = redis_conn
+        self._counter = None
+        self.executor = executor
+
+    def current_version(self):
+        return self._alias[0] or 0
+
+    async def _resolve(self):
+        """ Refresh the cached alias of a versioned engine, see Librorum.current_version() """
+        if self.config['versioned'] and self.config['version'] is None and time.time() >= self._alias[1]:
+            version = int(await self.redis.get(self.alias) or 0)
+            self._alias = (version, time.time() + self.config['alias_ttl'])
+
+    async def _run(self, func, *args):
+        # the executor threads don't inherit the context, so the pinned namespace goes along
+        context = contextvars.copy_context()
+        return await asyncio.get_running_loop().run_in_executor(self.executor, context.run, func, *args)
+
+    @pinned
+    async def search(self, term, fields=None, **kwargs):
+        """ Same as Librorum.search """
+        term = await self._run(self.analyzer.search_term, term)
+        if self.config['scripted']:
+            return self._decode(await self._scripted_search(term, **kwargs), fields)
+        result = await self.retrieve(term, **kwargs)
+
+        if not result:
+            return []
+        return self._decode(await self.redis.hmget(self.database, *result), fields)
+
+    async def search_many(self, queries):
+        """ Run several searches concurrently. Every query is a term, or a dict of
+        the term and the search arguments. Results are in the order of `queries`.
+        """
+        return await asyncio.gather(*[self.search(term, **kwargs)
+                                      for term, kwargs in map(query_args, queries)])
+
+    async def _scripted_search(self, word, limit=0, offset=0, **kwargs):
+        words, dbs, rtv_keys, ranges = await self._parse(word, kwargs)
+        if not rtv_keys:
+            return []
+
+        if self._search_script is None:
+            self._search_script = self.redis.register_script(SEARCH_SCRIPT)
+        keys, args = self._script_args(words, dbs, rtv_keys, ranges, limit, offset)
+        ids, docs = await self._search_script(keys=keys, args=args)
+        return docs
+
+    @pinned
+    async def retrieve(self, word, limit=0, offset=0, **kwargs):
+        """ Same as Librorum.retrieve """
+        words, dbs, rtv_keys, ranges = await self._parse(word, kwargs)
+        if not rtv_keys:
+            return []
+
+        if self.config['cached']:
+            rtv_key = self._result_key(words, dbs, await self.redis.get(self.generation) or 0, ranges)
+            pipe = self.redis.pipeline()
+            pipe.exists(rtv_key)
+            pipe.zrange(rtv_key, offset, limit-1)
+            exists, result = await pipe.execute()
+            if not exists:
+                temps = self._store_ranges(pipe, ranges)
+                pipe.zinterstore(rtv_key, self._weights(rtv_keys, temps))
+                pipe.expire(rtv_key, self.config['cache_ttl'])
+                pipe.zrange(rtv_key, offset, limit-1)
+                result = (await self._execute(pipe, temps))[-1]
+        else:
+            rtv_key = self._temp_key()
+            pipe = self.redis.pipeline(transaction=False)
+            temps = self._store_ranges(pipe, ranges)
+            pipe.zinterstore(rtv_key, self._weights(rtv_keys, temps))
+            pipe.expire(rtv_key, TEMP_TTL)
+            pipe.zrange(rtv_key, offset, limit-1)
+            pipe.delete(rtv_key)
+            result = (await self._execute(pipe, temps))[2]
+
+        return list(map(int, result))
+
+    async def _execute(self, pipe, temps):
+        """ Same as Librorum._execute """
+        if temps:
+            pipe.unlink(*temps)
+        return self._replies(await pipe.execute(), temps)
+
+    async def _parse(self, word, kwargs):
+        if self.config['max_prefix']:
+            return await self._run(self._query, word, kwargs)
+        return self._query(word, kwargs)
+
+    async def add_item(self, item):
+        """ Same as Librorum.add_item """
+        await self.add_items([item])
+
+    @pinned
+    async def add_items(self, items, batch_size=1000):
+        """ Add items in batches of `batch_size`, one pipeline per batch """
+        for items in chunks(items, batch_size):
+            batch = await self._run(self._collect, items)
+            if batch is None:
+                continue
+            reverse = batch[-1]
+            pipe = self.redis.pipeline(transaction=False)
+            pipe.hmget(self.reverse, *reverse)
+            pipe.hmget(self.popularity, *reverse)
+            raws, hits = await pipe.execute()
+            entries = self._merge_reverse(reverse, raws)
+            self._boost(batch[1], reverse, hits)
+
+            self._queue_batch(pipe, batch, entries)
+            await pipe.execute()
+
+    @pinned
+    async def flush(self, count=1000):
+        """ Same as Librorum.flush """
+        for pattern in ('%s*' % self.indexbase, '%s*' % self.resultbase):
+            keys = []
+            async for key in self.redis.scan_iter(match=pattern, count=count):
+                keys.append(key)
+                if len(keys) >= count:
+                    await self.redis.unlink(*keys)
+                    keys = []
+            if keys:
+                await self.redis.unlink(*keys)
+        await self.redis.unlink(self.database, self.indexbase, self.generation, self.reverse,
+                                self.popularity)
+
+    async def del_item(self, uid):
+        """ Same as Librorum.del_item """
+        await self.del_items([uid])
+
+    @pinned
+    async def del_items(self, uids):
+        """ Same as Librorum.del_items """
+        uids = list(map(str, uids))
+        if not uids:
+            return
+        pipe = self.redis.pipeline()
+        self._queue_delete(pipe, uids, await self.redis.hmget(self.reverse, *uids))
+        await pipe.execute()
+
+    async def record_hit(self, uid, count=1):
+        """ Same as Librorum.record_hit """
+        if self._count_hit(uid, count):
+            await self.flush_hits()
+
+    @pinned
+    async def flush_hits(self):
+        """ Same as Librorum.flush_hits """
+        hits = self._take_hits()
+        for batch in chunks(hits.items(), self.config['hit_batch']):
+            raws = await self.redis.hmget(self.reverse, *[uid for uid, _ in batch])
+            pipe = self.redis.pipeline()
+            self._queue_hits(pipe, batch, raws)
+            await pipe.execute()
+        return sum(hits.values())
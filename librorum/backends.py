@@ -0,0 +1,768 @@
+# coding: utf-8
+import fnmatch
+import heapq
+import re
+import threading
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+
+
+class Backend(object):
+    """ The redis-py client commands Librorum relies on. Any object with these
+    methods, and the same return types as a redis-py client without
+    `decode_responses`, can be given to Librorum as its connection. A pipeline
+    queues the same commands, and its `execute()` returns their replies.
+
+    `register_script` and `memory_usage` are optional: without them Librorum
+    falls back to its multi-call search, and stats() leaves memory unestimated.
+    """
+
+    # Keyspace
+
+    def exists(self, *names):
+        raise NotImplementedError
+
+    def delete(self, *names):
+        raise NotImplementedError
+
+    def unlink(self, *names):
+        raise NotImplementedError
+
+    def type(self, name):
+        raise NotImplementedError
+
+    def expire(self, name, seconds):
+        raise NotImplementedError
+
+    def ttl(self, name):
+        raise NotImplementedError
+
+    def keys(self, pattern='*'):
+        raise NotImplementedError
+
+    def scan(self, cursor=0, match=None, count=None):
+        raise NotImplementedError
+
+    def scan_iter(self, match=None, count=None):
+        raise NotImplementedError
+
+    # Strings and lists
+
+    def get(self, name):
+        raise NotImplementedError
+
+    def set(self, name, value):
+        raise NotImplementedError
+
+    def getset(self, name, value):
+        raise NotImplementedError
+
+    def incr(self, name, amount=1):
+        raise NotImplementedError
+
+    def rpush(self, name, *values):
+        raise NotImplementedError
+
+    def lindex(self, name, index):
+        raise NotImplementedError
+
+    def lpop(self, name):
+        raise NotImplementedError
+
+    # Hashes
+
+    def hset(self, name, key=None, value=None, mapping=None):
+        raise NotImplementedError
+
+    def hincrby(self, name, key, amount=1):
+        raise NotImplementedError
+
+    def hget(self, name, key):
+        raise NotImplementedError
+
+    def hmget(self, name, keys, *args):
+        raise NotImplementedError
+
+    def hexists(self, name, key):
+        raise NotImplementedError
+
+    def hdel(self, name, *keys):
+        raise NotImplementedError
+
+    def hlen(self, name):
+        raise NotImplementedError
+
+    def hscan_iter(self, name, match=None, count=None):
+        raise NotImplementedError
+
+    # Sets
+
+    def sadd(self, name, *values):
+        raise NotImplementedError
+
+    def srem(self, name, *values):
+        raise NotImplementedError
+
+    def smembers(self, name):
+        raise NotImplementedError
+
+    def sismember(self, name, value):
+        raise NotImplementedError
+
+    def smismember(self, name, values, *args):
+        raise NotImplementedError
+
+    def scard(self, name):
+        raise NotImplementedError
+
+    def sscan(self, name, cursor=0, match=None, count=None):
+        raise NotImplementedError
+
+    # Sorted sets
+
+    def zadd(self, name, mapping, xx=False, incr=False):
+        raise NotImplementedError
+
+    def zrem(self, name, *values):
+        raise NotImplementedError
+
+    def zcard(self, name):
+        raise NotImplementedError
+
+    def zscan(self, name, cursor=0, match=None, count=None):
+        raise NotImplementedError
+
+    def zscore(self, name, value):
+        raise NotImplementedError
+
+    def zmscore(self, key, members):
+        raise NotImplementedError
+
+    def zrange(self, name, start, end, withscores=False):
+        raise NotImplementedError
+
+    def zrangestore(self, dest, name, start, end, byscore=False):
+        raise NotImplementedError
+
+    def zremrangebyrank(self, name, min, max):
+        raise NotImplementedError
+
+    def zinterstore(self, dest, keys, aggregate=None):
+        raise NotImplementedError
+
+    # Transactions
+
+    def pipeline(self, transaction=True):
+        raise NotImplementedError
+
+
+class SortedSet(object):
+    """ A posting list: members sorted by (score, member) like a Redis zset, with
+    their scores in a compact array of doubles. Scores are looked up in the same
+    pairs sorted by member, in a list and an array too, rather than in a dict. """
+
+    __slots__ = ('scores', 'members', 'keys', 'values')
+
+    # batches of more changes are merged in linear time instead of inserted one by one
+    MERGE_SIZE = 16
+
+    def __init__(self, entries=()):
+        """ `entries` are (score, member) pairs of distinct members """
+        entries = sorted(entries)
+        self.scores = array('d', (score for score, _ in entries))
+        self.members = [member for _, member in entries]
+        entries.sort(key=lambda entry: entry[1])
+        self.keys = [member for _, member in entries]
+        self.values = array('d', (score for score, _ in entries))
+
+    def __len__(self):
+        return len(self.members)
+
+    def items(self):
+        """ The (member, score) pairs, sorted by member """
+        return zip(self.keys, self.values)
+
+    def _position(self, score, member):
+        lo = bisect_left(self.scores, score)
+        hi = bisect_right(self.scores, score, lo)
+        return bisect_left(self.members, member, lo, hi)
+
+    def _key(self, member):
+        """ The position of `member` in self.keys, None when it is not a member """
+        position = bisect_left(self.keys, member)
+        if position < len(self.keys) and self.keys[position] == member:
+            return position
+        return None
+
+    def score(self, member):
+        position = self._key(member)
+        return None if position is None else self.values[position]
+
+    def add(self, member, score):
+        """ Set the score of `member`, returns whether it is a new member """
+        old = self.score(member)
+        if old == score:
+            return False
+        if old is not None:
+            self.remove(member)
+        position = self._position(score, member)
+        self.scores.insert(position, score)
+        self.members.insert(position, member)
+        position = bisect_left(self.keys, member)
+        self.keys.insert(position, member)
+        self.values.insert(position, score)
+        return old is None
+
+    def update(self, mapping):
+        """ Set the scores of the members of `mapping`, returns the number of new members.
+        Large batches are sorted and merged, copying the current entries once. """
+        changes = {}
+        moved = []
+        for member, score in mapping.items():
+            old = self.score(member)
+            if old != score:
+                changes[member] = score
+                if old is not None:
+                    moved.append(member)
+        if len(changes) <= self.MERGE_SIZE:
+            for member, score in changes.items():
+                self.add(member, score)
+            return len(changes) - len(moved)
+
+        for member in moved:
+            self.remove(member)
+        entries = sorted((score, member) for member, score in changes.items())
+        positions = [self._position(score, member) for score, member in entries]
+        self.scores = merge_at(self.scores, positions, [score for score, _ in entries])
+        self.members = merge_at(self.members, positions, [member for _, member in entries])
+        members = sorted(changes)
+        positions = [bisect_left(self.keys, member) for member in members]
+        self.keys = merge_at(self.keys, positions, members)
+        self.values = merge_at(self.values, positions, [changes[member] for member in members])
+        return len(changes) - len(moved)
+
+    def remove(self, member):
+        position = self._key(member)
+        if position is None:
+            return False
+        score = self.values[position]
+        del self.keys[position]
+        del self.values[position]
+        position = self._position(score, member)
+        del self.scores[position]
+        del self.members[position]
+        return True
+
+    def rank_range(self, start, end):
+        """ Entries between the ranks `start` and `end` included, negative ranks count from the end """
+        length = len(self.members)
+        if start < 0:
+            start += length
+        if end < 0:
+            end += length
+        start = max(start, 0)
+        end = min(end, length - 1)
+        if start > end:
+            return []
+        return list(zip(self.members[start:end+1], self.scores[start:end+1]))
+
+    def score_range(self, low, high):
+        """ Entries with a score between the bounds `low` and `high`, given in the
+        ZRANGE BYSCORE syntax: '(' excludes a bound, '-inf' and '+inf' are open """
+        low, low_excluded = score_bound(low)
+        high, high_excluded = score_bound(high)
+        start = (bisect_right if low_excluded else bisect_left)(self.scores, low)
+        end = (bisect_left if high_excluded else bisect_right)(self.scores, high)
+        return list(zip(self.members[start:end], self.scores[start:end]))
+
+    def remove_rank_range(self, start, end):
+        entries = self.rank_range(start, end)
+        for member, _ in entries:
+            self.remove(member)
+        return len(entries)
+
+
+def merge_at(sequence, positions, values):
+    """ A copy of the list or array `sequence` with `values` inserted before the
+    ascending `positions` of the original """
+    merged = sequence[:0]
+    start = 0
+    for position, value in zip(positions, values):
+        merged += sequence[start:position]
+        merged.append(value)
+        start = position
+    merged += sequence[start:]
+    return merged
+
+
+def score_bound(value):
+    """ A score bound of ZRANGE BYSCORE as (score, excluded) """
+    value = encode(value).decode()
+    if value.startswith('('):
+        return float(value[1:]), True
+    return float(value), False
+
+
+def encode(value):
+    """ Encode a value the way redis-py sends it """
+    if isinstance(value, bytes):
+        return value
+    if isinstance(value, float):
+        return repr(value).encode()
+    if not isinstance(value, str):
+        value = str(value)
+    return value.encode('utf-8')
+
+
+class MemoryBackend(Backend):
+    """ A pure-Python, thread-safe, in-process stand-in for the Redis commands
+    used by Librorum. It embeds the index in the application: no server and no
+    network hop. Keys expire lazily, scripts are not supported so Librorum
+    falls back to its multi-call search.
+    """
+
+    def __init__(self):
+        self._data = {}
+        self._expires = {}
+        self._order = []
+        self._sequence = {}
+        self._counter = 0
+        self._lock = threading.RLock()
+
+    # Keyspace
+
+    def _get(self, name, kind=None):
+        name = encode(name)
+        deadline = self._expires.get(name)
+        if deadline is not None and deadline <= time.time():
+            self._remove(name)
+        value = self._data.get(name)
+        if value is not None and kind is not None and not isinstance(value, kind):
+            raise TypeError('WRONGTYPE Operation against a key holding the wrong kind of value')
+        return value
+
+    def _create(self, name, value):
+        name = encode(name)
+        if name not in self._data:
+            self._counter += 1
+            self._sequence[name] = self._counter
+            self._order.append((self._counter, name))
+        self._data[name] = value
+        return value
+
+    def _remove(self, name):
+        self._expires.pop(name, None)
+        self._sequence.pop(name, None)
+        return self._data.pop(name, None) is not None
+
+    def _drop_if_empty(self, name):
+        value = self._data.get(encode(name))
+        if value is not None and not value:
+            self._remove(encode(name))
+
+    def _live_keys(self):
+        return [name for name in list(self._data) if self._get(name) is not None]
+
+    def exists(self, *names):
+        with self._lock:
+            return sum(1 for name in names if self._get(name) is not None)
+
+    def delete(self, *names):
+        with self._lock:
+            return sum(1 for name in names if self._get(name) is not None and self._remove(encode(name)))
+
+    unlink = delete
+
+    def type(self, name):
+        with self._lock:
+            value = self._get(name)
+        return {bytes: b'string', dict: b'hash', set: b'set', list: b'list',
+                SortedSet: b'zset'}.get(type(value), b'none')
+
+    def expire(self, name, seconds):
+        with self._lock:
+            if self._get(name) is None:
+                return False
+            self._expires[encode(name)] = time.time() + seconds
+            return True
+
+    def ttl(self, name):
+        with self._lock:
+            if self._get(name) is None:
+                return -2
+            deadline = self._expires.get(encode(name))
+            return -1 if deadline is None else int(round(deadline - time.time()))
+
+    def keys(self, pattern='*'):
+        match = self._matcher(pattern)
+        with self._lock:
+            return [name for name in self._live_keys() if match(name)]
+
+    def scan(self, cursor=0, match=None, count=None, **kwargs):
+        """ Keys are visited in creation order and the cursor is the creation number
+        of the last visited key, so every key living through the scan is returned """
+        matcher = self._matcher(match or '*')
+        count = count or 10
+        with self._lock:
+            if len(self._order) > 2 * len(self._data) + 64:
+                self._order = [(number, name) for number, name in self._order
+                               if self._sequence.get(name) == number]
+            position = bisect_left(self._order, (int(cursor) + 1,))
+            keys = []
+            for number, name in self._order[position:position+count]:
+                cursor = number
+                if self._sequence.get(name) == number and self._get(name) is not None and matcher(name):
+                    keys.append(name)
+            if position + count >= len(self._order):
+                cursor = 0
+            return cursor, keys
+
+    def scan_iter(self, match=None, count=None, **kwargs):
+        cursor = None
+        while cursor != 0:
+            cursor, keys = self.scan(cursor or 0, match=match, count=count)
+            for key in keys:
+                yield key
+
+    def _scan_members(self, members, cursor, count):
+        """ Up to `count` of `members` in byte order, after the member encoded by `cursor`.
+        The cursor of the next call encodes the last returned member, 0 at the end, so
+        that changes during the scan do not make it skip the members living through it """
+        cursor = int(cursor)
+        if cursor:
+            last = cursor.to_bytes((cursor.bit_length() + 7) // 8, 'big')[1:]
+            members = (member for member in members if member > last)
+        batch = heapq.nsmallest((count or 10) + 1, members)
+        if len(batch) <= (count or 10):
+            return 0, batch
+        batch.pop()
+        return int.from_bytes(b'\x01' + batch[-1], 'big'), batch
+
+    def _matcher(self, pattern):
+        regex = re.compile(fnmatch.translate(encode(pattern).decode('utf-8', 'surrogateescape')), re.S)
+        return lambda name: regex.match(name.decode('utf-8', 'surrogateescape')) is not None
+
+    # Strings and lists
+
+    def get(self, name):
+        with self._lock:
+            return self._get(name, bytes)
+
+    def set(self, name, value):
+        with self._lock:
+            self._expires.pop(encode(name), None)
+            self._create(name, encode(value))
+            return True
+
+    def getset(self, name, value):
+        with self._lock:
+            old = self._get(name, bytes)
+            self.set(name, value)
+            return old
+
+    def incr(self, name, amount=1):
+        with self._lock:
+            value = int(self._get(name, bytes) or 0) + amount
+            self._create(name, encode(value))
+            return value
+
+    def rpush(self, name, *values):
+        with self._lock:
+            items = self._get(name, list)
+            if items is None:
+                items = self._create(name, [])
+            items.extend(map(encode, values))
+            return len(items)
+
+    def lindex(self, name, index):
+        with self._lock:
+            items = self._get(name, list) or []
+            try:
+                return items[index]
+            except IndexError:
+                return None
+
+    def lpop(self, name):
+        with self._lock:
+            items = self._get(name, list)
+            if not items:
+                return None
+            value = items.pop(0)
+            self._drop_if_empty(name)
+            return value
+
+    # Hashes
+
+    def hset(self, name, key=None, value=None, mapping=None):
+        fields = dict(mapping or {})
+        if key is not None:
+            fields[key] = value
+        with self._lock:
+            data = self._get(name, dict)
+            if data is None:
+                data = self._create(name, {})
+            added = 0
+            for field, field_value in fields.items():
+                field = encode(field)
+                added += field not in data
+                data[field] = encode(field_value)
+            return added
+
+    def hincrby(self, name, key, amount=1):
+        with self._lock:
+            data = self._get(name, dict)
+            if data is None:
+                data = self._create(name, {})
+            value = int(data.get(encode(key), 0)) + amount
+            data[encode(key)] = encode(value)
+            return value
+
+    def hget(self, name, key):
+        with self._lock:
+            return (self._get(name, dict) or {}).get(encode(key))
+
+    def hmget(self, name, keys, *args):
+        if isinstance(keys, (str, bytes, int)):
+            keys = [keys]
+        with self._lock:
+            data = self._get(name, dict) or {}
+            return [data.get(encode(key)) for key in list(keys) + list(args)]
+
+    def hexists(self, name, key):
+        with self._lock:
+            return encode(key) in (self._get(name, dict) or {})
+
+    def hdel(self, name, *keys):
+        with self._lock:
+            data = self._get(name, dict) or {}
+            removed = sum(1 for key in keys if data.pop(encode(key), None) is not None)
+            self._drop_if_empty(name)
+            return removed
+
+    def hlen(self, name):
+        with self._lock:
+            return len(self._get(name, dict) or {})
+
+    def hscan_iter(self, name, match=None, count=None):
+        """ The fields of the hash at the time of the call, with their values """
+        matcher = self._matcher(match or '*')
+        with self._lock:
+            fields = list((self._get(name, dict) or {}).items())
+        for field, value in fields:
+            if matcher(field):
+                yield field, value
+
+    # Sets
+
+    def sadd(self, name, *values):
+        with self._lock:
+            members = self._get(name, set)
+            if members is None:
+                members = self._create(name, set())
+            size = len(members)
+            members.update(map(encode, values))
+            return len(members) - size
+
+    def srem(self, name, *values):
+        with self._lock:
+            members = self._get(name, set)
+            if members is None:
+                return 0
+            size = len(members)
+            members.difference_update(map(encode, values))
+            self._drop_if_empty(name)
+            return size - len(members)
+
+    def smembers(self, name):
+        with self._lock:
+            return set(self._get(name, set) or ())
+
+    def sismember(self, name, value):
+        with self._lock:
+            return encode(value) in (self._get(name, set) or ())
+
+    def smismember(self, name, values, *args):
+        with self._lock:
+            members = self._get(name, set) or ()
+            return [int(encode(value) in members) for value in list(values) + list(args)]
+
+    def scard(self, name):
+        with self._lock:
+            return len(self._get(name, set) or ())
+
+    def sscan(self, name, cursor=0, match=None, count=None):
+        with self._lock:
+            return self._scan_members(list(self._get(name, set) or ()), cursor, count)
+
+    # Sorted sets
+
+    def zadd(self, name, mapping, xx=False, incr=False):
+        with self._lock:
+            zset = self._get(name, SortedSet)
+            if zset is None:
+                if xx:
+                    return None if incr else 0
+                zset = self._create(name, SortedSet())
+            if incr:
+                (member, score), = mapping.items()
+                old = zset.score(encode(member))
+                if old is None and xx:
+                    return None
+                zset.add(encode(member), (old or 0) + float(score))
+                return zset.score(encode(member))
+            mapping = dict((encode(member), float(score)) for member, score in mapping.items())
+            if xx:
+                mapping = dict((member, score) for member, score in mapping.items()
+                               if zset.score(member) is not None)
+            return zset.update(mapping)
+
+    def zrem(self, name, *values):
+        with self._lock:
+            zset = self._get(name, SortedSet)
+            if zset is None:
+                return 0
+            removed = sum(1 for value in values if zset.remove(encode(value)))
+            self._drop_if_empty(name)
+            return removed
+
+    def zcard(self, name):
+        with self._lock:
+            return len(self._get(name, SortedSet) or ())
+
+    def zscan(self, name, cursor=0, match=None, count=None, **kwargs):
+        with self._lock:
+            zset = self._get(name, SortedSet)
+            if zset is None:
+                return 0, []
+            cursor, members = self._scan_members(zset.keys, cursor, count)
+            return cursor, [(member, zset.score(member)) for member in members]
+
+    def zscore(self, name, value):
+        with self._lock:
+            zset = self._get(name, SortedSet)
+            return None if zset is None else zset.score(encode(value))
+
+    def zmscore(self, key, members):
+        with self._lock:
+            zset = self._get(key, SortedSet)
+            return [None if zset is None else zset.score(encode(member)) for member in members]
+
+    def zrange(self, name, start, end, withscores=False):
+        with self._lock:
+            zset = self._get(name, SortedSet)
+            entries = [] if zset is None else zset.rank_range(start, end)
+        if withscores:
+            return entries
+        return [member for member, _ in entries]
+
+    def zrangestore(self, dest, name, start, end, byscore=False, **kwargs):
+        with self._lock:
+            zset = self._get(name, SortedSet)
+            if zset is None:
+                entries = []
+            elif byscore:
+                entries = zset.score_range(start, end)
+            else:
+                entries = zset.rank_range(start, end)
+            self._remove(encode(dest))
+            if entries:
+                self._create(dest, SortedSet((score, member) for member, score in entries))
+            return len(entries)
+
+    def zremrangebyrank(self, name, min, max):
+        with self._lock:
+            zset = self._get(name, SortedSet)
+            if zset is None:
+                return 0
+            removed = zset.remove_rank_range(min, max)
+            self._drop_if_empty(name)
+            return removed
+
+    def _weighted_sources(self, keys):
+        """ The (members, weight) pairs of the keys of a ZINTERSTORE, as SortedSet
+        or plain sets, which count as zsets whose scores are all 1 """
+        weights = keys if isinstance(keys, dict) else dict((key, 1) for key in keys)
+        sources = []
+        for key, weight in weights.items():
+            value = self._get(key)
+            if value is None:
+                value = set()
+            elif not isinstance(value, (SortedSet, set)):
+                raise TypeError('WRONGTYPE Operation against a key holding the wrong kind of value')
+            sources.append((value, weight))
+        return sources
+
+    def zinterstore(self, dest, keys, aggregate=None):
+        aggregate = {None: sum, 'SUM': sum, 'MIN': min, 'MAX': max}[aggregate and aggregate.upper()]
+        with self._lock:
+            if len(keys) == 1 and not isinstance(keys, dict):
+                return self._copy(keys[0], dest)
+            sources = sorted(self._weighted_sources(keys), key=lambda source: len(source[0]))
+            entries = []
+            if sources:
+                (smallest, weight), others = sources[0], sources[1:]
+                pairs = smallest.items() if isinstance(smallest, SortedSet) else ((member, 1.0) for member in smallest)
+                for member, score in pairs:
+                    scores = [score * weight]
+                    for members, other_weight in others:
+                        score = members.score(member) if isinstance(members, SortedSet) else \
+                            (1.0 if member in members else None)
+                        if score is None:
+                            break
+                        scores.append(score * other_weight)
+                    else:
+                        entries.append((aggregate(scores), member))
+            self._remove(encode(dest))
+            if entries:
+                self._create(dest, SortedSet(entries))
+            return len(entries)
+
+    def _copy(self, name, dest):
+        """ ZINTERSTORE of a single key """
+        value = self._get(name)
+        if not isinstance(value, SortedSet):
+            return self.zinterstore(dest, {name: 1})
+        copy = SortedSet()
+        copy.scores = array('d', value.scores)
+        copy.members = list(value.members)
+        copy.keys = list(value.keys)
+        copy.values = array('d', value.values)
+        self._remove(encode(dest))
+        self._create(dest, copy)
+        return len(copy)
+
+    # Transactions
+
+    def pipeline(self, transaction=True):
+        return MemoryPipeline(self)
+
+
+class MemoryPipeline(object):
+    """ Buffer commands and run them at once under the backend lock """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.commands = []
+
+    def __getattr__(self, name):
+        method = getattr(self.backend, name)
+
+        def queue(*args, **kwargs):
+            self.commands.append((method, args, kwargs))
+            return self
+        return queue
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.commands = []
+
+    def __len__(self):
+        return len(self.commands)
+
+    def execute(self):
+        commands, self.commands = self.commands, []
+        with self.backend._lock:
+            return [method(*args, **kwargs) for method, args, kwargs in commands]
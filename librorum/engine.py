@@ -1,119 +1,1658 @@
 # coding: utf-8
+import contextvars
+import functools
+import heapq
+import inspect
 import json
-from pypinyin import lazy_pinyin, NORMAL
-import jieba
+import time
+import threading
+import uuid
+from collections import defaultdict, OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import islice
 
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 
-class Librorum(object):
-    """ A search engine for phrase autocompletition and searching engine based on Redis
+from .metrics import NULL_STAGE, CountingConnection, Stage
+
+
+SEARCH_SCRIPT = """
+-- KEYS: generation counter, database hash, the keys to intersect, the range keys
+-- ARGV: result key prefix, result key suffix, start, stop, ttl (0 removes the result key),
+--       number of range keys, then the min and max scores of each range key
+local ttl = tonumber(ARGV[5])
+local ranges = tonumber(ARGV[6] or 0)
+local generation = '0'
+if ttl > 0 then
+    generation = redis.call('GET', KEYS[1]) or '0'
+end
+local dest = ARGV[1] .. generation .. '_' .. ARGV[2]
+
+if ttl == 0 or redis.call('EXISTS', dest) == 0 then
+    local inputs = {}
+    local weights = {}
+    for i = 3, #KEYS - ranges do
+        inputs[#inputs + 1] = KEYS[i]
+        weights[#weights + 1] = 1
+    end
+    local temps = {}
+    for i = 1, ranges do
+        temps[i] = dest .. '|' .. i
+        redis.call('ZRANGESTORE', temps[i], KEYS[#KEYS - ranges + i], ARGV[5 + 2 * i], ARGV[6 + 2 * i], 'BYSCORE')
+        inputs[#inputs + 1] = temps[i]
+        weights[#weights + 1] = 0
+    end
+    local args = {dest, #inputs}
+    for i = 1, #inputs do
+        args[#args + 1] = inputs[i]
+    end
+    args[#args + 1] = 'WEIGHTS'
+    for i = 1, #weights do
+        args[#args + 1] = weights[i]
+    end
+    redis.call('ZINTERSTORE', unpack(args))
+    if ranges > 0 then
+        redis.call('DEL', unpack(temps))
+    end
+    if ttl > 0 then
+        redis.call('EXPIRE', dest, ttl)
+    end
+end
+
+local ids = redis.call('ZRANGE', dest, ARGV[3], ARGV[4])
+if ttl == 0 then
+    redis.call('DEL', dest)
+end
+
+local docs = {}
+for i = 1, #ids, 1000 do
+    local chunk = redis.call('HMGET', KEYS[2], unpack(ids, i, math.min(i + 999, #ids)))
+    for j = 1, #chunk do
+        docs[#docs + 1] = chunk[j]
+    end
+end
+return {ids, docs}
+"""
+
+
+TEMP_TTL = 10     # Seconds before a temporary result key left behind by a failed client expires
+
+RANGE_OPERATORS = ('gt', 'gte', 'lt', 'lte')
+
+
+def pinned(method):
+    """ Resolve the namespace of a versioned engine once for a whole call of `method`,
+    so that it reads and writes one version even if the alias switches meanwhile. The
+    namespace is kept in a context variable of the engine for the nested calls, and
+    for every step of a generator.
+    """
+    if inspect.isgeneratorfunction(method):
+        @functools.wraps(method)
+        def generate(self, *args, **kwargs):
+            context = self._pin()
+            steps = context.run(method, self, *args, **kwargs)
+            try:
+                while True:
+                    try:
+                        item = context.run(next, steps)
+                    except StopIteration:
+                        return
+                    yield item
+            finally:
+                context.run(steps.close)
+        return generate
+
+    @functools.wraps(method)
+    def call(self, *args, **kwargs):
+        if not self.config['versioned'] or self._pinned.get() is not None:
+            return method(self, *args, **kwargs)
+        return self._pin().run(method, self, *args, **kwargs)
+    return call
+
+
+class BaseLibrorum(object):
+    """ The config, the key layout and the Redis-independent parts of the engines,
+    shared by Librorum and librorum.aio.AsyncLibrorum. Subclasses run the commands,
+    and give the version of a versioned engine by current_version().
     """
-    RESERVED_WORDS = set(('db', 'idx', 'uid', 'term', 'limit'))       # Reserved word by now
+    RESERVED_WORDS = set(('db', 'idx', 'uid', 'term', 'limit', 'fields'))       # Reserved word by now
 
     def __init__(self, redis_conn, **kwargs):
         self.config = dict(
             engine_name='',
             structure=dict(),
             cached=False,
+            cache_ttl=60,
+            scripted=False,
             base_score=1,
+            workers=1,
+            cache_size=10000,
+            versioned=False,
+            version=None,
+            alias_ttl=1,
+            max_prefix=None,
+            short_prefix=0,
+            top_k=None,
+            metrics=None,
+            planner=True,
+            planner_ttl=1,
+            probe_limit=64,
+            threads=8,
+            codec='json',
+            table_fields=None,
+            cursor_ttl=300,
+            dictionary=None,
+            hit_weight=0.1,
+            hit_interval=10,
+            hit_batch=1000,
         )
         self.config.update(kwargs)
 
-        self.database = '%s_db' % self.config['engine_name']
-        self.indexbase = '%s_idx' % self.config['engine_name']
-        self.redis = redis_conn
+        engine_name = self.config['engine_name']
+        self.alias = '%s_alias' % engine_name
+        self.versions = '%s_versions' % engine_name
+        self.retired = '%s_retired' % engine_name
+        self._counter = CountingConnection(redis_conn) if self.config['metrics'] else None
+        self.redis = self._counter or redis_conn
+        self.analyzer = Analyzer(self.config['cache_size'], self.config['max_prefix'], self.config['dictionary'])
+        self.codec = self.make_codec(self.config['codec'])
+        self._readers = [self.codec] + [self.make_codec(name) for name in sorted(CODECS)
+                                        if name != self.config['codec'] and (name != 'msgpack' or msgpack)]
+        self._ranged = sorted(k for k, kind in self.config['structure'].items() if kind in (int, float))
+        self._search_script = None
+        self._alias = (None, 0)
+        self._pinned = contextvars.ContextVar('namespace', default=None)
+        self._cardinalities = LRUCache(self.config['cache_size'])
+        self._probes = True
+        self._executor = None
+        self._executor_lock = threading.Lock()
+        self._hits = defaultdict(int)
+        self._hits_lock = threading.Lock()
+        self._hits_flushed = time.time()
 
         if self.RESERVED_WORDS.intersection(self.config['structure'].keys()):
             raise Exception('structure 中不可存在保留字（%s）！' % str(self.RESERVED_WORDS))
 
-    def search(self, term, **kwargs):
+    def make_codec(self, name):
+        """ The document codec called `name`. The field table of codec `table` is config
+        `table_fields`, by default uid, term and the structure keys. """
+        if name == 'table':
+            return TableCodec(self.config['table_fields'] or
+                              ['uid', 'term'] + sorted(self.config['structure']))
+        if name not in CODECS:
+            raise Exception('unknown codec %r, choose from %s' % (name, ', '.join(sorted(CODECS))))
+        return CODECS[name]()
+
+    def warmup(self):
+        """ Load the tokenizer now instead of on the first query or write: jieba with
+        the config `dictionary` (see librorum.dictionary) or its own, its HMM model,
+        and the pypinyin tables. """
+        self.analyzer.load()
+
+    @property
+    def namespace(self):
+        """ Prefix of every key of the index. Versioned engines read the current
+        version from the alias key, unless pinned to one by config `version`, or
+        resolved for the whole public call in progress, see pinned().
+        """
+        if not self.config['versioned']:
+            return self.config['engine_name']
+        namespace = self._pinned.get()
+        if namespace is not None:
+            return namespace
+        version = self.config['version']
+        if version is None:
+            version = self.current_version()
+        return '%s_v%s' % (self.config['engine_name'], version)
+
+    @property
+    def database(self):
+        return '%s_db' % self.namespace
+
+    @property
+    def indexbase(self):
+        return '%s_idx' % self.namespace
+
+    @property
+    def resultbase(self):
+        return '%s_rtv' % self.namespace
+
+    @property
+    def generation(self):
+        return '%s_gen' % self.namespace
+
+    @property
+    def reverse(self):
+        return '%s_rev' % self.namespace
+
+    @property
+    def popularity(self):
+        return '%s_pop' % self.namespace
+
+    def _pin(self):
+        """ A copy of the current context, with the namespace of the engine resolved """
+        context = contextvars.copy_context()
+        if self.config['versioned'] and context.get(self._pinned) is None:
+            context.run(self._pinned.set, self.namespace)
+        return context
+
+    def _count_hit(self, uid, count):
+        """ Buffer the hits, and tell whether they are due to be flushed """
+        with self._hits_lock:
+            self._hits[str(uid)] += count
+        interval = self.config['hit_interval']
+        return interval is not None and time.time() >= self._hits_flushed + interval
+
+    def _take_hits(self):
+        with self._hits_lock:
+            hits, self._hits = self._hits, defaultdict(int)
+            self._hits_flushed = time.time()
+        return hits
+
+    def _queue_hits(self, pipe, batch, raws):
+        """ Queue the score changes of the (uid, count) hits of `batch`, given the raw
+        reverse entries of their items """
+        weight = self.config['hit_weight'] * self.config['base_score']
+        for (uid, count), raw in zip(batch, raws):
+            if raw is None:
+                continue
+            zsets, _ = self._reverse_entry(raw)
+            pipe.hincrby(self.popularity, uid, count)
+            for suffix in zsets:
+                if not suffix.endswith(':range'):
+                    pipe.zadd('%s_%s' % (self.indexbase, suffix), {uid: -weight * count}, xx=True, incr=True)
+        pipe.incr(self.generation)
+
+    def _boost(self, zsets, reverse, raws):
+        """ Lower the scores of the writes `zsets`, {key: {uid: score}}, of the items of
+        `reverse` by their popularity `raws`, as kept by self.flush_hits() """
+        weight = self.config['hit_weight'] * self.config['base_score']
+        for uid, raw in zip(list(reverse), raws):
+            if not raw:
+                continue
+            boost = weight * int(raw)
+            for suffix in reverse[uid][0]:
+                if not suffix.endswith(':range'):
+                    zsets['%s_%s' % (self.indexbase, suffix)][uid] -= boost
+
+    def _decode(self, docs, fields=None):
+        """ Decode `docs` with the codec of the engine, or with the codec of their format
+        for the documents of another format, such as during self.convert_database().
+        Missing documents, of items deleted while still indexed, are left out. """
+        decode, matches = self.codec.decode, self.codec.matches
+        return [decode(doc, fields) if matches(doc) else self._reader(doc).decode(doc, fields)
+                for doc in docs if doc is not None]
+
+    def _reader(self, raw):
+        """ The codec of the format of the document `raw` """
+        for codec in self._readers:
+            if codec.matches(raw):
+                return codec
+        raise Exception('unknown document format %r' % raw[:16])
+
+    def _stage(self, name):
+        """ Context manager timing the stage `name` for the config `metrics` sink """
+        sink = self.config['metrics']
+        if sink is None:
+            return NULL_STAGE
+        return Stage(sink, name, self._counter)
+
+    def _count(self, name, value):
+        sink = self.config['metrics']
+        if sink is not None:
+            sink.count(name, value)
+
+    def _script_args(self, words, dbs, rtv_keys, ranges, limit, offset):
+        """ The KEYS and ARGV of SEARCH_SCRIPT """
+        ttl = self.config['cache_ttl'] if self.config['cached'] else 0
+        keys = [self.generation, self.database] + rtv_keys
+        args = [self.resultbase + '_', self._result_name(words, dbs, ranges), offset, limit-1, ttl, len(ranges)]
+        for field, low, high in ranges:
+            keys.append(self._range_key(field))
+            args.extend([low, high])
+        return keys, args
+
+    def _narrows(self, words, previous):
+        """ Whether the query `words` narrows the query `previous`: every previous word
+        is one of its words, so the previous result holds all of its results """
+        return bool(previous) and set(previous) < set(words)
+
+    def _temp_key(self):
+        return '%s_tmp_%s' % (self.resultbase, uuid.uuid4().hex)
+
+    def _store_ranges(self, pipe, ranges):
+        """ Queue on `pipe` the copy of the members of every range predicate into a
+        temporary key, by ZRANGESTORE BYSCORE. Returns the ZINTERSTORE weights of the
+        copies: 0, so that the values never add up to the scores of the results.
+        """
+        temps = {}
+        for field, low, high in ranges:
+            temp = self._temp_key()
+            pipe.zrangestore(temp, self._range_key(field), low, high, byscore=True)
+            temps[temp] = 0
+        return temps
+
+    def _weights(self, rtv_keys, temps):
+        """ The ZINTERSTORE keys of `rtv_keys` and of the range copies `temps` """
+        if not temps:
+            return rtv_keys
+        weights = dict((key, 1) for key in rtv_keys)
+        weights.update(temps)
+        return weights
+
+    def _replies(self, replies, temps):
+        if not temps:
+            return replies
+        return replies[len(temps):-1]
+
+    def _query(self, word, kwargs):
+        """ Split a query into its words, its structure sets, the keys to intersect
+        and its range predicates """
+        words = list(self.analyzer.compile(word))
+        dbs = self.dbs(kwargs)
+
+        rtv_keys = list(map(lambda word: "%s_%s" % (self.indexbase, word), words))
+        rtv_keys.extend(dbs)
+        return words, dbs, rtv_keys, self.range_filters(kwargs)
+
+    def range_filters(self, kwargs):
+        """ The range predicates of the search arguments `<field>__<operator>=<value>`,
+        as sorted (field, min, max) with min and max in the ZRANGE BYSCORE syntax """
+        bounds = {}
+        for key, value in kwargs.items():
+            field, _, operator = key.rpartition('__')
+            if operator not in RANGE_OPERATORS or not field:
+                continue
+            if field not in self._ranged:
+                raise Exception('%s is not a numeric structure field' % field)
+            low, high = bounds.get(field, ('-inf', '+inf'))
+            bound = ('%r' if operator.endswith('e') else '(%r') % float(value)
+            if operator.startswith('g'):
+                low = bound
+            else:
+                high = bound
+            bounds[field] = (low, high)
+        return sorted((field, low, high) for field, (low, high) in bounds.items())
+
+    def _result_key(self, words, dbs, generation=0, ranges=()):
+        """ Key of the intersection of `words` with the structure sets `dbs` and the range predicates """
+        return '%s_%d_%s' % (self.resultbase, int(generation), self._result_name(words, dbs, ranges))
+
+    def _result_name(self, words, dbs, ranges=()):
+        filters = sorted(map(self._suffix, dbs))
+        filters.extend('%s:[%s,%s]' % predicate for predicate in ranges)
+        return '%s|%s' % (' '.join(words), ','.join(filters))
+
+    def _collect(self, items, indexes=None):
+        """ Gather the writes of `items` by key, as (sets, zsets, docs, reverse) """
+        sets = defaultdict(list)
+        zsets = defaultdict(dict)
+        docs = {}
+        reverse = {}
+
+        for i, item in enumerate(items):
+            uid = item['uid']
+            term = item.get('term')
+            if term is None:
+                continue
+            docs[uid] = self.codec.encode(item)
+            rev_zsets, rev_sets = reverse.setdefault(str(uid), ({}, set()))
+            for db in self.dbs(item):
+                sets[db].append(uid)
+                rev_sets.add(self._suffix(db))
+            if indexes is None:
+                postings = self.postings(term)
+            else:
+                postings = self._postings(indexes[i])
+            postings.update(self.range_scores(item))
+            for key, score in postings.items():
+                zsets[key][str(uid)] = score
+                rev_zsets[self._suffix(key)] = score
+
+        if not docs:
+            return None
+        return sets, zsets, docs, reverse
+
+    def _queue_batch(self, pipe, batch, entries):
+        """ Queue the writes gathered by self._collect() on `pipe` """
+        sets, zsets, docs, _ = batch
+        for db, uids in sets.items():
+            pipe.sadd(db, *uids)
+        for key, mapping in zsets.items():
+            pipe.zadd(key, mapping)
+            self._truncate(pipe, key)
+        pipe.hset(self.database, mapping=docs)
+        pipe.hset(self.reverse, mapping=entries)
+        pipe.incr(self.generation)
+
+    @pinned
+    def postings(self, term, score=None):
+        """ Get the index keys of `term` with the score of each key, `score` being
+        the base score, config `base_score` by default """
+        with self._stage('get_indexes'):
+            indexes = self.analyzer.get_indexes(term.lower())
+        return self._postings(indexes, score)
+
+    def _truncate(self, pipe, key):
+        """ Keep only the config `top_k` best members of the prefix keys no longer
+        than config `short_prefix` """
+        top_k = self.config['top_k']
+        if top_k and len(self._suffix(key)) <= self.config['short_prefix'] and not key.endswith(':range'):
+            pipe.zremrangebyrank(key, top_k, -1)
+
+    def _postings(self, indexes, score=None):
+        if score is None:
+            score = self.config['base_score']
+        return dict(('%s_%s' % (self.indexbase, k), weight*score)
+                    for k, weight in indexes.items()
+                    if weight not in (0, None))
+
+    def _merge_reverse(self, reverse, raws):
+        """ Merge the written keys of every uid, given as {uid: ({zset: score}, set([set]))},
+        into its existing reverse index entry from `raws`. Returns the encoded entries.
+        """
+        entries = {}
+        for uid, raw in zip(list(reverse), raws):
+            zsets, sets = self._reverse_entry(raw)
+            zsets.update(reverse[uid][0])
+            sets.update(reverse[uid][1])
+            entries[uid] = self._encode_reverse(zsets, sets)
+        return entries
+
+    def _encode_reverse(self, zsets, sets):
+        return json.dumps([zsets, sorted(sets)], separators=(',', ':'))
+
+    def _reverse_entry(self, raw):
+        """ Decode a reverse index entry into the suffixes of the keys an item was written to,
+        as ({zset: score}, set([set])) """
+        if raw is None:
+            return {}, set()
+        zsets, sets = json.loads(raw.decode())
+        return zsets, set(sets)
+
+    def _suffix(self, key):
+        return key[len(self.indexbase)+1:]
+
+    @pinned
+    def dbs(self, item):
+        dbs = []
+
+        for k in self.config['structure']:
+            v = item.get(k)
+            if v is not None:
+                dbs.append('%s_%s=%s' % (self.indexbase, k, item[k]))
+
+        return dbs
+
+    @pinned
+    def range_scores(self, item):
+        """ The range keys of the numeric structure fields of `item`, with its value in each """
+        scores = {}
+        for k in self._ranged:
+            v = item.get(k)
+            if v is not None:
+                scores[self._range_key(k)] = float(v)
+        return scores
+
+    def _range_key(self, field):
+        """ Sorted set of the uids with a value of the numeric structure field, scored by the value """
+        return '%s_%s:range' % (self.indexbase, field)
+
+    def _queue_delete(self, pipe, uids, raws):
+        """ Queue the removal of the items `uids`, given their raw reverse entries """
+        zsets = defaultdict(list)
+        sets = defaultdict(list)
+        for uid, raw in zip(uids, raws):
+            rev_zsets, rev_sets = self._reverse_entry(raw)
+            for suffix in rev_zsets:
+                zsets[suffix].append(uid)
+            for suffix in rev_sets:
+                sets[suffix].append(uid)
+
+        for suffix, members in zsets.items():
+            pipe.zrem('%s_%s' % (self.indexbase, suffix), *members)
+        for suffix, members in sets.items():
+            pipe.srem('%s_%s' % (self.indexbase, suffix), *members)
+        pipe.hdel(self.database, *uids)
+        pipe.hdel(self.reverse, *uids)
+        pipe.hdel(self.popularity, *uids)
+        pipe.incr(self.generation)
+
+
+class Librorum(BaseLibrorum):
+    """ A search engine for phrase autocompletition and searching engine based on Redis
+    """
+
+    def current_version(self):
+        """ Version the alias points to, cached for config `alias_ttl` seconds """
+        version, expires = self._alias
+        if version is None or time.time() >= expires:
+            version = int(self.redis.get(self.alias) or 0)
+            self._alias = (version, time.time() + self.config['alias_ttl'])
+        return version
+
+    def rebuild(self):
+        """ Get an engine pinned to a new version of this versioned index. Items
+        added to it are not served until it is published with self.publish().
+        """
+        assert self.config['versioned'], 'rebuild() needs a versioned engine'
+        config = dict(self.config, version=self.redis.incr(self.versions))
+        return self.__class__(self.redis, **config)
+
+    def publish(self, builder):
+        """ Switch the alias to the version of `builder` atomically. The previous
+        version is retired, and is removed later on by self.reclaim(). Publishing
+        the live version again, such as a retried publish, retires nothing.
+        """
+        previous = self.redis.getset(self.alias, builder.config['version'])
+        self._alias = (None, 0)
+        if previous is not None and int(previous) != int(builder.config['version']):
+            self.redis.rpush(self.retired, '%s:%s' % (int(previous), time.time()))
+
+    def reclaim(self, count=1000):
+        """ One step of the removal of retired versions, unlinking about `count` keys.
+        A version is only reclaimed once the alias caches of the readers have expired.
+        The version the alias points to is never reclaimed, its entry is dropped.
+        Returns False when there is nothing left to reclaim.
+        """
+        retired = self.redis.lindex(self.retired, 0)
+        if retired is None:
+            return False
+        version, since = retired.decode().split(':')
+        if int(version) == int(self.redis.get(self.alias) or 0):
+            self.redis.lpop(self.retired)
+            return True
+        if time.time() < float(since) + self.config['alias_ttl']:
+            return True
+
+        cursor_key = '%s_cursor' % self.retired
+        cursor = int(self.redis.get(cursor_key) or 0)
+        cursor, keys = self.redis.scan(cursor, match='%s_v%s_*' % (self.config['engine_name'], version),
+                                       count=count)
+        pipe = self.redis.pipeline()
+        if keys:
+            pipe.unlink(*keys)
+        if cursor:
+            pipe.set(cursor_key, cursor)
+        else:
+            pipe.delete(cursor_key)
+            pipe.lpop(self.retired)
+        pipe.execute()
+        return True
+
+    def reclaim_in_background(self, interval=0.1, count=1000):
+        """ Run self.reclaim() in a daemon thread until nothing is left to reclaim """
+        def run():
+            while self.reclaim(count):
+                time.sleep(interval)
+
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def record_hit(self, uid, count=1):
+        """ Count `count` picks of the item `uid`. Hits are buffered in the process,
+        and flushed by self.flush_hits() once config `hit_interval` seconds passed
+        since the last flush (never when None). """
+        if self._count_hit(uid, count):
+            self.flush_hits()
+
+    @pinned
+    def flush_hits(self):
+        """ Move the buffered hits to Redis, in one MULTI per config `hit_batch` items.
+        Every hit lowers the scores of the item by config `hit_weight` times `base_score`
+        in each index key listed by its reverse entry, by ZADD XX INCR so that keys the
+        item was truncated from are left alone. The hits of an item are kept in the
+        popularity hash, so that rewrites of the item keep its boost.
+        Returns the number of hits flushed.
+        """
+        hits = self._take_hits()
+        for batch in chunks(hits.items(), self.config['hit_batch']):
+            raws = self.redis.hmget(self.reverse, *[uid for uid, _ in batch])
+            pipe = self.redis.pipeline()
+            self._queue_hits(pipe, batch, raws)
+            pipe.execute()
+        return sum(hits.values())
+
+    def flush_hits_in_background(self, interval=None):
+        """ Run self.flush_hits() every `interval` seconds, config `hit_interval` by default,
+        in a daemon thread """
+        if interval is None:
+            interval = self.config['hit_interval']
+        if interval is None or interval <= 0:
+            raise Exception('flush_hits_in_background() needs a positive interval, got %r' % interval)
+
+        def run():
+            while True:
+                time.sleep(interval)
+                self.flush_hits()
+
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    @pinned
+    def search(self, term, fields=None, **kwargs):
         """ Get the result from database, accepted args are:
         term: word for searching
         limit: how many results you need
         offset: the offset of searching result
+        fields: the item fields to return, all of them when None
+        <field>=<value>: only the items whose structure field equals value
+        <field>__gte, __gt, __lte, __lt=<value>: only the items whose numeric
+            structure field is within the range
+
+        With config `scripted=True` and a client supporting scripts, the whole
+        search runs as one Lua script on the server.
         """
-        term = ''.join(lazy_pinyin(term))
-        result = self.retrieve(term, **kwargs)
+        with self._stage('search'):
+            with self._stage('search.pinyin'):
+                term = self.analyzer.search_term(term)
+            if self.config['scripted'] and hasattr(self.redis, 'register_script'):
+                return self._decode(self._scripted_search(term, **kwargs), fields)
+            result = self.retrieve(term, **kwargs)
 
-        if len(result) is 0:
+            if len(result) is 0:
+                return []
+            with self._stage('search.fetch'):
+                return self._decode(self.redis.hmget(self.database, *result), fields)
+
+    def search_many(self, queries):
+        """ Run a batch of searches on a pool of config `threads` threads sharing the
+        connection pool. Every query is a term, or a dict of the term and the search
+        arguments. Results are in the order of `queries`.
+        """
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(self.config['threads'])
+        futures = [self._executor.submit(self.search, term, **kwargs)
+                   for term, kwargs in map(query_args, queries)]
+        return [future.result() for future in futures]
+
+    def _scripted_search(self, word, limit=0, offset=0, **kwargs):
+        words, dbs, rtv_keys, ranges = self._query(word, kwargs)
+        if not rtv_keys:
             return []
-        return list(map(lambda s: json.loads(s.decode()),
-                        self.redis.hmget(self.database, *result)))
 
+        if self._search_script is None:
+            self._search_script = self.redis.register_script(SEARCH_SCRIPT)
+        keys, args = self._script_args(words, dbs, rtv_keys, ranges, limit, offset)
+        ids, docs = self._search_script(keys=keys, args=args)
+        return docs
+
+    @pinned
     def retrieve(self, word, limit=0, offset=0, **kwargs):
         """ Get uid list by word, args are the same as self.search """
-        word = word.lower()
-        words = filter(lambda x: x and True or False, word.split(' '))
+        return list(map(int, self._retrieve(word, limit, offset, kwargs)))
 
-        rtv_key = "%s_%s" % (self.indexbase, word)
-        rtv_keys = list(map(lambda word: "%s_%s" % (self.indexbase, word), words))
-        rtv_keys.extend(self.dbs(kwargs))
+    @pinned
+    def retrieve_scored(self, word, limit=0, offset=0, **kwargs):
+        """ Same as self.retrieve, as (uid, score) pairs """
+        return [(int(uid), score) for uid, score in self._retrieve(word, limit, offset, kwargs, True)]
+
+    def _retrieve(self, word, limit, offset, kwargs, withscores=False):
+        """ The members ranked between `offset` and `limit`, with their scores if `withscores` """
+        with self._stage('retrieve'):
+            words, dbs, rtv_keys, ranges = self._query(word, kwargs)
+            if not rtv_keys:
+                return []
+            self._count('retrieve.keys', len(rtv_keys))
+
+            if self.config['planner']:
+                with self._stage('retrieve.plan'):
+                    cardinalities = self._cardinality(words, dbs)
+                    if not all(cardinalities.values()):
+                        return []
+                    rtv_keys.sort(key=cardinalities.get)
+                    smallest = rtv_keys[0]
+                    if (self._probes and not self.config['cached'] and not ranges and smallest in dbs and
+                            cardinalities[smallest] <= self.config['probe_limit']):
+                        probed = self._probe(rtv_keys, dbs, offset, limit-1, withscores)
+                        if probed is not None:
+                            return probed
+
+            with self._stage('retrieve.intersect'):
+                if self.config['cached']:
+                    rtv_key = self._result_key(words, dbs, self.redis.get(self.generation) or 0, ranges)
+                    pipe = self.redis.pipeline()
+                    pipe.exists(rtv_key)
+                    pipe.zrange(rtv_key, offset, limit-1, withscores=withscores)
+                    exists, result = pipe.execute()
+                    if not exists:
+                        temps = self._store_ranges(pipe, ranges)
+                        pipe.zinterstore(rtv_key, self._weights(rtv_keys, temps))
+                        pipe.expire(rtv_key, self.config['cache_ttl'])
+                        pipe.zrange(rtv_key, offset, limit-1, withscores=withscores)
+                        cardinality, _, result = self._execute(pipe, temps)
+                        self._count('retrieve.cardinality', cardinality)
+                else:
+                    rtv_key = self._temp_key()
+                    pipe = self.redis.pipeline(transaction=False)
+                    temps = self._store_ranges(pipe, ranges)
+                    pipe.zinterstore(rtv_key, self._weights(rtv_keys, temps))
+                    pipe.expire(rtv_key, TEMP_TTL)
+                    pipe.zrange(rtv_key, offset, limit-1, withscores=withscores)
+                    pipe.delete(rtv_key)
+                    cardinality, _, result, _ = self._execute(pipe, temps)
+                    self._count('retrieve.cardinality', cardinality)
+
+            return result
+
+    @pinned
+    def retrieve_page(self, word, cursor=None, count=100, **kwargs):
+        """ One page of the uids of a query, as (uids, next_cursor). The first page
+        stores the intersection in a result key kept for config `cursor_ttl` seconds
+        after each page; the next pages are read from it with the cursor returned by
+        the previous page, and the same word and filters. A cursor whose key expired
+        runs the intersection again. next_cursor is None after the last page, and the
+        result key is then removed.
+        """
+        with self._stage('retrieve_page'):
+            words, dbs, rtv_keys, ranges = self._query(word, kwargs)
+            if not rtv_keys:
+                return [], None
+            if cursor is None:
+                token, position = uuid.uuid4().hex, 0
+            else:
+                token, position = cursor.rsplit(':', 1)
+                position = int(position)
+            rtv_key = '%s_cur_%s' % (self.resultbase, token)
+            ttl = self.config['cursor_ttl']
+
+            pipe = self.redis.pipeline(transaction=False)
+            if cursor is not None:
+                pipe.zcard(rtv_key)
+                pipe.zrange(rtv_key, position, position+count-1)
+                pipe.expire(rtv_key, ttl)
+                cardinality, result, _ = pipe.execute()
+            if cursor is None or not cardinality:
+                temps = self._store_ranges(pipe, ranges)
+                pipe.zinterstore(rtv_key, self._weights(rtv_keys, temps))
+                pipe.expire(rtv_key, ttl)
+                pipe.zrange(rtv_key, position, position+count-1)
+                cardinality, _, result = self._execute(pipe, temps)
+
+            position += len(result)
+            if position >= cardinality:
+                self.redis.delete(rtv_key)
+                return list(map(int, result)), None
+            return list(map(int, result)), '%s:%d' % (token, position)
+
+    @pinned
+    def iter_retrieve(self, word, chunk_size=1000, **kwargs):
+        """ Generate the uids of a query, read by pages of `chunk_size` from one
+        result key, see self.retrieve_page() """
+        cursor = None
+        try:
+            while True:
+                uids, cursor = self.retrieve_page(word, cursor, chunk_size, **kwargs)
+                for uid in uids:
+                    yield uid
+                if cursor is None:
+                    return
+        finally:
+            if cursor is not None:
+                self.redis.delete('%s_cur_%s' % (self.resultbase, cursor.rsplit(':', 1)[0]))
+
+    @pinned
+    def iter_search(self, term, chunk_size=1000, fields=None, **kwargs):
+        """ Generate the items of a search, with the documents fetched and decoded
+        by pages of `chunk_size`. Args are the same as self.search """
+        term = self.analyzer.search_term(term)
+        for uids in chunks(self.iter_retrieve(term, chunk_size, **kwargs), chunk_size):
+            for item in self._decode(self.redis.hmget(self.database, *uids), fields):
+                yield item
+
+    @pinned
+    def typeahead(self, term, previous=None, limit=0, offset=0, fields=None, **kwargs):
+        """ Same as self.search, for the successive keystrokes of a user. Result keys
+        are kept for config `cache_ttl` seconds, and reused by the next keystrokes:
+
+        - when every word of the `previous` query of the user, the term minus its last
+          character by default, is a word of the new query, the new result is narrowed
+          from the result key of the previous one: only the added words are intersected
+        - otherwise the structure sets and range predicates of the query are
+          intersected once into a filter key, shared by the queries with the same filters
+
+        An extended word is not narrowed from its prefix, as the key of a whole term
+        holds items the keys of its prefixes do not. Queries of a single word and no
+        filter are read from the key of the word.
+        """
+        with self._stage('typeahead'):
+            uids = self._typeahead(term, term[:-1] if previous is None else previous, limit, offset, kwargs)
+            if not uids:
+                return []
+            with self._stage('search.fetch'):
+                return self._decode(self.redis.hmget(self.database, *uids), fields)
+
+    def _typeahead(self, term, previous, limit, offset, kwargs):
+        words = self.analyzer.compile(self.analyzer.search_term(term))
+        if not words:
+            return []
+        dbs = self.dbs(kwargs)
+        ranges = self.range_filters(kwargs)
+        word_keys = ['%s_%s' % (self.indexbase, word) for word in words]
+        if len(word_keys) == 1 and not dbs and not ranges:
+            return list(map(int, self.redis.zrange(word_keys[0], offset, limit-1)))
 
-        self.redis.zinterstore(rtv_key, rtv_keys)
+        narrowed = ()
+        if previous:
+            narrowed = self.analyzer.compile(self.analyzer.search_term(previous))
+            if not self._narrows(words, narrowed):
+                narrowed = ()
 
-        return list(map(int, self.redis.zrange(rtv_key, offset, limit-1)))
+        ttl = self.config['cache_ttl']
+        generation = self.redis.get(self.generation) or 0
+        rtv_key = self._result_key(words, dbs, generation, ranges)
+        filter_key = self._result_key((), dbs, generation, ranges) if ranges or len(dbs) > 1 else None
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.exists(rtv_key)
+        pipe.zrange(rtv_key, offset, limit-1)
+        # Extends the keys to reuse, so that they outlive the next round-trip
+        if narrowed:
+            previous_key = self._result_key(narrowed, dbs, generation, ranges)
+            pipe.expire(previous_key, ttl)
+        if filter_key:
+            pipe.expire(filter_key, ttl)
+        replies = pipe.execute()
+        if replies[0]:
+            return list(map(int, replies[1]))
+        replies = replies[2:]
 
+        temps = {}
+        if narrowed and replies.pop(0):
+            self._count('typeahead.narrowed', 1)
+            keys = ['%s_%s' % (self.indexbase, word) for word in words if word not in narrowed]
+            keys.append(previous_key)
+        elif filter_key:
+            if not replies[0]:
+                temps = self._store_ranges(pipe, ranges)
+                pipe.zinterstore(filter_key, self._weights(dbs, temps))
+                pipe.expire(filter_key, ttl)
+            keys = word_keys + [filter_key]
+        else:
+            keys = word_keys + dbs
+        pipe.zinterstore(rtv_key, keys)
+        pipe.expire(rtv_key, ttl)
+        pipe.zrange(rtv_key, offset, limit-1)
+        replies = self._execute(pipe, temps)
+        self._count('retrieve.cardinality', replies[-3])
+        return list(map(int, replies[-1]))
+
+    def _execute(self, pipe, temps):
+        """ Remove the range copies `temps` at the end of `pipe` and execute it.
+        Returns the replies of the other commands. """
+        if temps:
+            pipe.unlink(*temps)
+        return self._replies(pipe.execute(), temps)
+
+    def _cardinality(self, words, dbs):
+        """ Cardinalities of the keys of a query. Non-empty ones are cached
+        for config `planner_ttl` seconds, empty ones are always checked again.
+        """
+        now = time.time()
+        cardinalities = {}
+        missing = []
+        for key in ['%s_%s' % (self.indexbase, word) for word in words] + dbs:
+            cached = self._cardinalities.get(key)
+            if cached is not None and cached[1] > now:
+                cardinalities[key] = cached[0]
+            else:
+                missing.append(key)
+
+        if missing:
+            pipe = self.redis.pipeline(transaction=False)
+            for key in missing:
+                if key in dbs:
+                    pipe.scard(key)
+                else:
+                    pipe.zcard(key)
+            expires = now + self.config['planner_ttl']
+            for key, cardinality in zip(missing, pipe.execute()):
+                cardinalities[key] = cardinality
+                if cardinality:
+                    self._cardinalities.set(key, (cardinality, expires))
+        return cardinalities
+
+    def _probe(self, rtv_keys, dbs, start, end, withscores=False):
+        """ Intersect by probing the members of the small structure set `rtv_keys[0]`
+        in the other keys. Scores add up in the order of ZINTERSTORE, from the smallest
+        key to the largest, so the ranking is the same as with an intersection.
+        Returns None, and stops probing, on servers without SMISMEMBER and ZMSCORE.
+        """
+        members = sorted(self.redis.smembers(rtv_keys[0]))
+        pipe = self.redis.pipeline(transaction=False)
+        for key in rtv_keys[1:]:
+            if key in dbs:
+                pipe.smismember(key, members)
+            else:
+                pipe.zmscore(key, members)
+
+        try:
+            replies = pipe.execute()
+        except Exception as e:
+            # both came with Redis 6.2
+            if 'unknown command' not in str(e).lower():
+                raise
+            self._probes = False
+            return None
+
+        scores = dict((member, 1.0) for member in members)
+        for key, values in zip(rtv_keys[1:], replies):
+            for member, value in zip(members, values):
+                if member not in scores:
+                    continue
+                # ZMSCORE gives None for non-members, and 0 is a valid score
+                missing = not value if key in dbs else value is None
+                if missing:
+                    del scores[member]
+                else:
+                    scores[member] += 1.0 if key in dbs else value
+
+        ranked = sorted(scores, key=lambda member: (scores[member], member))
+        ranked = rank_range(ranked, start, end)
+        if withscores:
+            return [(member, scores[member]) for member in ranked]
+        return ranked
+
+    @pinned
     def add_item(self, item):
         """ Add new item to database. Item excepted as dict type. Steps:
         1. Save the item to database
         2. Word segementation by blank and Jieba for Chinese
         3. Save the indexes to indexbase
         """
-        uid = item['uid']
+        with self._stage('add_item'):
+            self._write_batch([item])
+
+    @pinned
+    def update_item(self, item):
+        """ Update an item in place. The old and new index keys are compared through
+        the reverse index, and only the changed ones are written, in one MULTI.
+        Items without a reverse index entry are added as new.
+        """
+        uid = str(item['uid'])
         term = item.get('term')
         if term is None:
             return
-        self.store(item, uid)
-        self.index(term, uid)
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.hget(self.reverse, uid)
+        pipe.hget(self.popularity, uid)
+        raw, hits = pipe.execute()
+        if raw is None:
+            return self.add_item(item)
+        boost = self.config['hit_weight'] * self.config['base_score'] * int(hits or 0)
+
+        old_zsets, old_sets = self._reverse_entry(raw)
+        zsets = self.postings(term)
+        zsets.update(self.range_scores(item))
+        zsets = dict((self._suffix(key), score) for key, score in zsets.items())
+        sets = set(map(self._suffix, self.dbs(item)))
+
+        pipe = self.redis.pipeline()
+        for suffix in set(old_zsets) - set(zsets):
+            pipe.zrem('%s_%s' % (self.indexbase, suffix), uid)
+        for suffix, score in zsets.items():
+            if old_zsets.get(suffix) != score:
+                if not suffix.endswith(':range'):
+                    score -= boost
+                pipe.zadd('%s_%s' % (self.indexbase, suffix), {uid: score})
+                self._truncate(pipe, '%s_%s' % (self.indexbase, suffix))
+        for suffix in old_sets - sets:
+            pipe.srem('%s_%s' % (self.indexbase, suffix), uid)
+        for suffix in sets - old_sets:
+            pipe.sadd('%s_%s' % (self.indexbase, suffix), uid)
+        pipe.hset(self.database, uid, self.codec.encode(item))
+        pipe.hset(self.reverse, uid, self._encode_reverse(zsets, sets))
+        pipe.incr(self.generation)
+        pipe.execute()
 
-    def index(self, term, uid, score=1):
-        """ Index term and uid with base score
+    @pinned
+    def add_items(self, items, batch_size=1000, callback=None, workers=None):
+        """ Add items in batches. Every batch is sent through one pipeline, with one
+        SADD/ZADD per key carrying all the members of the batch.
+
+        items: iterable of items, consumed lazily
+        batch_size: how many items are written per pipeline
+        callback: called as callback(done, batch_stats) after each batch
+        workers: size of the tokenizer process pool, defaults to config `workers`
+
+        Returns the list of batch stats, dicts with `items`, `seconds` and `rate` (items/sec).
         """
-        term = term.lower()
+        if workers is None:
+            workers = self.config['workers']
 
-        for k, v in get_indexes(term).items():
-            self._index(k, v, uid, score)
+        stats = []
+        done = 0
+        start = time.time()
+        for batch, indexes in tokenized_batches(items, batch_size, workers, self.config['cache_size'],
+                                                self.config['max_prefix'], self.config['dictionary']):
+            self._write_batch(batch, indexes)
+            seconds = time.time() - start
+            batch_stats = dict(items=len(batch), seconds=seconds,
+                               rate=len(batch) / seconds if seconds else float('inf'))
+            stats.append(batch_stats)
+            done += len(batch)
+            if callback is not None:
+                callback(done, batch_stats)
+            start = time.time()
+        return stats
 
-    def _index(self, term, weight, uid, score):
-        if weight in (0, None):
-            pass
-        else:
-            self.redis.zadd('%s_%s' % (self.indexbase, term),
-                            **{str(uid): weight*score})
+    @pinned
+    def _write_batch(self, items, indexes=None):
+        """ Write `items` in one pipeline, `indexes` are the precomputed
+        get_indexes() results of their terms, if any. Pinned, as the loader and
+        ShardedLibrorum call it directly. """
+        batch = self._collect(items, indexes)
+        if batch is None:
+            return
+        reverse = batch[-1]
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.hmget(self.reverse, *reverse)
+        pipe.hmget(self.popularity, *reverse)
+        raws, hits = pipe.execute()
+        entries = self._merge_reverse(reverse, raws)
+        self._boost(batch[1], reverse, hits)
+
+        self._queue_batch(pipe, batch, entries)
+        pipe.execute()
+
+    @pinned
+    def index(self, term, uid, score=None):
+        """ Index term and uid with base score, config `base_score` by default
+        """
+        with self._stage('index'):
+            postings = self.postings(term, score)
+            reverse = {str(uid): (dict((self._suffix(key), _score) for key, _score in postings.items()), set())}
+            self._count('index.keys', len(postings))
+
+            pipe = self.redis.pipeline(transaction=False)
+            pipe.hmget(self.reverse, *reverse)
+            pipe.hmget(self.popularity, *reverse)
+            raws, hits = pipe.execute()
+            zsets = defaultdict(dict, ((key, {str(uid): _score}) for key, _score in postings.items()))
+            self._boost(zsets, reverse, hits)
+            for key, mapping in zsets.items():
+                pipe.zadd(key, mapping)
+                self._truncate(pipe, key)
+            pipe.hset(self.reverse, mapping=self._merge_reverse(reverse, raws))
+            pipe.incr(self.generation)
+            pipe.execute()
 
+    @pinned
     def store(self, item, uid=None):
         if not uid:
-            uid = item.get(uid)
+            uid = item.get('uid')
         assert uid is not None
 
-        for db in self.dbs(item):
-            self.redis.sadd(db, uid)
+        dbs = self.dbs(item)
+        ranges = self.range_scores(item)
+        reverse = {str(uid): (dict((self._suffix(key), value) for key, value in ranges.items()),
+                              set(map(self._suffix, dbs)))}
 
-        self.redis.hset(self.database, uid, json.dumps(item))
+        pipe = self.redis.pipeline(transaction=False)
+        for db in dbs:
+            pipe.sadd(db, uid)
+        for key, value in ranges.items():
+            pipe.zadd(key, {uid: value})
+        pipe.hset(self.database, uid, self.codec.encode(item))
+        pipe.hset(self.reverse, mapping=self._merge_reverse(reverse, self.redis.hmget(self.reverse, *reverse)))
+        pipe.incr(self.generation)
+        pipe.execute()
 
-    def dbs(self, item):
-        dbs = []
+    @pinned
+    def flush(self, count=1000):
+        """ Clean all the keys used by Librorum. Keys are found by SCAN and removed
+        by UNLINK, in batches of about `count`, so the server is never blocked.
+        """
+        for pattern in ('%s*' % self.indexbase, '%s*' % self.resultbase):
+            for keys in chunks(self.redis.scan_iter(match=pattern, count=count), count):
+                self.redis.unlink(*keys)
+        self.redis.unlink(self.database, self.indexbase, self.generation, self.reverse, self.popularity)
 
-        for k in self.config['structure']:
-            v = item.get(k)
-            if v is not None:
-                dbs.append('%s_%s=%s' % (self.indexbase, k, item[k]))
+    @pinned
+    def convert_database(self, source=None, count=1000):
+        """ Re-encode the documents stored by the codec `source` (a codec name), or by any
+        other codec when None, with the codec of this engine. The database is read by
+        HSCAN and written back in pipelines of about `count` documents. Documents are
+        decoded by the codec of their format meanwhile, so it can be converted while
+        serving, and a conversion stopped halfway can be run again. Returns the number
+        of converted documents.
+        """
+        source = source and self.make_codec(source)
+        converted = 0
+        for docs in chunks(self.redis.hscan_iter(self.database, count=count), count):
+            mapping = {}
+            for uid, raw in docs:
+                if self.codec.matches(raw) or (source and not source.matches(raw)):
+                    continue
+                mapping[uid] = self.codec.encode(self._reader(raw).decode(raw))
+            if mapping:
+                self.redis.hset(self.database, mapping=mapping)
+                converted += len(mapping)
+        return converted
 
-        return dbs
+    @pinned
+    def del_item(self, uid):
+        """ Remove an item from the database and from every key it was indexed in """
+        self.del_items([uid])
+
+    @pinned
+    def del_items(self, uids):
+        """ Remove items by the reverse index, in one pipeline """
+        uids = list(map(str, uids))
+        if not uids:
+            return
 
-    def flush(self):
-        """ Clean all the keys used by Librorum """
-        prefixs = self.redis.keys('%s*' % self.indexbase)
-        for prefix in prefixs:
-            self.redis.delete(prefix)
-        self.redis.delete(self.database)
-        self.redis.delete(self.indexbase)
+        pipe = self.redis.pipeline()
+        self._queue_delete(pipe, uids, self.redis.hmget(self.reverse, *uids))
+        pipe.execute()
 
-    def del_item(self, uid):
-        pass
+    @pinned
+    def sweep(self, cursor=0, count=100):
+        """ One incremental garbage collection step over about `count` index members:
+        removes the members whose item is no longer in the database, such as items
+        deleted before they had a reverse index entry. Redis drops the keys left
+        empty. Keys are found by SCAN and walked by ZSCAN or SSCAN, so large keys are
+        swept over several steps. `cursor` is 0 for the first step, and the cursor
+        returned by the previous step otherwise. Returns 0 once the whole index was swept.
+        """
+        scan, keys, position = cursor or (0, (), 0)
+        pipe = self.redis.pipeline(transaction=False)
+        if not keys:
+            scan, names = self.redis.scan(scan, match='%s_*' % self.indexbase, count=count)
+            for name in names:
+                pipe.type(name)
+            types = pipe.execute()
+            for name, key_type in zip(names, types):
+                if key_type in (b'zset', 'zset'):
+                    pipe.zcard(name)
+                else:
+                    pipe.scard(name)
+            keys = tuple(zip(names, types, pipe.execute()))
+            position = 0
+
+        # scan whole keys while their cardinality fits in `count`, and the next one partly
+        budget = count
+        scanned = []
+        for name, key_type, cardinality in keys:
+            if budget <= 0:
+                break
+            start = position if not scanned else 0
+            if key_type in (b'zset', 'zset'):
+                pipe.zscan(name, start, count=min(cardinality, budget) or 1)
+            elif key_type in (b'set', 'set'):
+                pipe.sscan(name, start, count=min(cardinality, budget) or 1)
+            else:
+                pipe.exists(name)
+            scanned.append((name, key_type))
+            budget -= cardinality or 1
+
+        members = []
+        done = 0
+        for (name, key_type), reply in zip(scanned, pipe.execute()):
+            if key_type in (b'zset', 'zset'):
+                position, found = reply[0], [member for member, _ in reply[1]]
+            elif key_type in (b'set', 'set'):
+                position, found = reply
+            else:
+                position, found = 0, []
+            members.append(found)
+            if int(position):
+                break
+            done += 1
+        keys = keys[done:]
+
+        uids = list(set().union(*members))
+        for uid in uids:
+            pipe.hexists(self.database, uid)
+        orphans = set(uid for uid, exists in zip(uids, pipe.execute()) if not exists)
+        if orphans:
+            for (name, key_type), found in zip(scanned, members):
+                removed = orphans.intersection(found)
+                if not removed:
+                    continue
+                if key_type in (b'zset', 'zset'):
+                    pipe.zrem(name, *removed)
+                else:
+                    pipe.srem(name, *removed)
+            pipe.incr(self.generation)
+            pipe.execute()
+
+        if not keys and not int(scan):
+            return 0
+        return scan, keys, position if keys else 0
+
+    @pinned
+    def stats(self, sample=20, top=10, count=1000):
+        """ Account for the keys of the engine, found by an incremental SCAN in steps of
+        about `count` keys. Returns a dict with:
+
+        keys: number of keys of the namespace
+        classes: by key class (db, rev, pop, gen, idx, range, sets, rtv, tmp, cur), the
+            number of keys and members and, from MEMORY USAGE of the first `sample` keys
+            of the class, the estimated memory in bytes (None if not available)
+        prefixes: by length of the prefix of the idx keys, the number of keys and members,
+            the largest cardinality and a histogram of the cardinalities by power of 2
+        largest: the `top` largest idx keys, as [suffix, cardinality]
+        leaked: the result keys without TTL or of an older generation, their number and
+            up to `top` of their names
+        """
+        generation = self.redis.get(self.generation)
+        generation = int(generation or 0)
+        named = {self.database: 'db', self.reverse: 'rev', self.popularity: 'pop', self.generation: 'gen'}
+        classes = defaultdict(lambda: dict(keys=0, members=0, sampled=[]))
+        prefixes = defaultdict(lambda: dict(keys=0, members=0, max=0, histogram=defaultdict(int)))
+        largest = []
+        leaked = dict(keys=0, names=[])
+        total = 0
+
+        pipe = self.redis.pipeline(transaction=False)
+        for keys in chunks(self.redis.scan_iter(match='%s_*' % self.namespace, count=count), count):
+            keys = [key.decode() if isinstance(key, bytes) else key for key in keys]
+            for key in keys:
+                pipe.type(key)
+                pipe.ttl(key)
+            replies = pipe.execute()
+            types = [t.decode() if isinstance(t, bytes) else t for t in replies[::2]]
+            for key, key_type in zip(keys, types):
+                getattr(pipe, dict(zset='zcard', set='scard', hash='hlen').get(key_type, 'exists'))(key)
+            sizes = pipe.execute()
+
+            for key, key_type, ttl, size in zip(keys, types, replies[1::2], sizes):
+                if key_type == 'none':
+                    continue
+                total += 1
+                kind = named.get(key) or self._key_class(key, key_type)
+                stats = classes[kind]
+                stats['keys'] += 1
+                stats['members'] += size
+                if len(stats['sampled']) < sample:
+                    stats['sampled'].append((key, size))
+
+                if kind == 'idx':
+                    suffix = self._suffix(key)
+                    prefix = prefixes[len(suffix)]
+                    prefix['keys'] += 1
+                    prefix['members'] += size
+                    prefix['max'] = max(prefix['max'], size)
+                    prefix['histogram'][1 << max(size - 1, 0).bit_length()] += 1
+                    item = (size, suffix)
+                    if len(largest) < top:
+                        heapq.heappush(largest, item)
+                    elif largest and item > largest[0]:
+                        heapq.heapreplace(largest, item)
+                elif kind in ('rtv', 'tmp', 'cur'):
+                    stale = kind == 'rtv' and key[len(self.resultbase)+1:].partition('_')[0] != str(generation)
+                    if ttl == -1 or stale:
+                        leaked['keys'] += 1
+                        if len(leaked['names']) < top:
+                            leaked['names'].append(key)
+
+        for stats in classes.values():
+            stats['memory'] = self._sampled_memory(stats.pop('sampled'), stats['keys'], stats['members'])
+        for prefix in prefixes.values():
+            prefix['histogram'] = dict(prefix['histogram'])
+        return dict(keys=total, generation=generation, classes=dict(classes), prefixes=dict(prefixes),
+                    largest=[[suffix, size] for size, suffix in sorted(largest, reverse=True)], leaked=leaked)
+
+    def _key_class(self, key, key_type):
+        """ The class of the key `key` of the namespace, for self.stats() """
+        if key.startswith(self.indexbase + '_'):
+            if key.endswith(':range'):
+                return 'range'
+            return 'sets' if key_type == 'set' else 'idx'
+        if key.startswith(self.resultbase + '_'):
+            kind = key[len(self.resultbase)+1:].partition('_')[0]
+            return kind if kind in ('tmp', 'cur') else 'rtv'
+        return 'other'
+
+    def _sampled_memory(self, sampled, keys, members):
+        """ Estimate the memory of a key class from the MEMORY USAGE of the `sampled`
+        (key, cardinality) pairs, scaled by members, or by keys for empty samples """
+        if not sampled or not hasattr(self.redis, 'memory_usage'):
+            return None
+        pipe = self.redis.pipeline(transaction=False)
+        for key, _ in sampled:
+            pipe.memory_usage(key)
+        usages = pipe.execute(raise_on_error=False)
+        measured = [(usage, size) for usage, (_, size) in zip(usages, sampled) if isinstance(usage, int)]
+        if not measured:
+            return None
+        used = sum(usage for usage, _ in measured)
+        sampled_members = sum(size for _, size in measured)
+        if sampled_members and members:
+            return int(used * members / sampled_members)
+        return int(used * keys / len(measured))
+
+
+def chunks(iterable, size):
+    """ Split `iterable` into lists of at most `size` items """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def rank_range(ranked, start, end):
+    """ Slice `ranked` like ZRANGE, `end` included and negative ranks counting from the end """
+    length = len(ranked)
+    if start < 0:
+        start += length
+    if end < 0:
+        end += length
+    return ranked[max(start, 0):end+1]
+
+
+def query_args(query):
+    """ Split a query of search_many() into the term and the search arguments """
+    if isinstance(query, dict):
+        kwargs = dict(query)
+        return kwargs.pop('term'), kwargs
+    return query, {}
+
+
+def project(item, fields):
+    return dict((field, item[field]) for field in fields if field in item)
+
+
+class JsonCodec(object):
+    """ Documents as JSON objects, the original format """
+
+    def encode(self, item):
+        return json.dumps(item)
+
+    def matches(self, raw):
+        """ Whether `raw` is in the format of the codec """
+        return raw[:1] == b'{'
+
+    def decode(self, raw, fields=None):
+        item = json.loads(raw.decode())
+        return item if fields is None else project(item, fields)
+
+
+class MsgpackCodec(object):
+    """ Documents as msgpack maps, smaller and faster to decode than JSON.
+    Needs the msgpack package. """
+
+    def __init__(self):
+        if msgpack is None:
+            raise ImportError('codec msgpack needs the msgpack package')
+
+    def encode(self, item):
+        return msgpack.packb(item, use_bin_type=True)
+
+    def matches(self, raw):
+        # fixmap, map 16 and map 32
+        return raw[:1] != b'' and (0x80 <= raw[0] <= 0x8f or raw[0] in (0xde, 0xdf))
+
+    def decode(self, raw, fields=None):
+        item = msgpack.unpackb(raw, raw=False, strict_map_key=False)
+        return item if fields is None else project(item, fields)
+
+
+class TableCodec(object):
+    """ Documents as compact JSON arrays of the values of a fixed field table, the
+    other fields of an item in a trailing object when it has any. Field names are
+    not stored, nor fields set to None. Changing the table needs the database to
+    be converted, see Librorum.convert_database().
+    """
+
+    def __init__(self, fields):
+        self.fields = list(fields)
+        self.positions = dict((field, i) for i, field in enumerate(self.fields))
+
+    def encode(self, item):
+        values = [item.get(field) for field in self.fields]
+        extra = dict((k, v) for k, v in item.items() if k not in self.positions)
+        while values and values[-1] is None and not extra:
+            values.pop()
+        if extra:
+            values.append(extra)
+        return json.dumps(values, ensure_ascii=False, separators=(',', ':'))
+
+    def matches(self, raw):
+        return raw[:1] == b'['
+
+    def decode(self, raw, fields=None):
+        values = json.loads(raw.decode())
+        extra = values.pop() if len(values) > len(self.fields) else {}
+        if fields is None:
+            item = dict((field, value) for field, value in zip(self.fields, values) if value is not None)
+            item.update(extra)
+            return item
+        item = {}
+        for field in fields:
+            i = self.positions.get(field)
+            if i is None:
+                if field in extra:
+                    item[field] = extra[field]
+            elif i < len(values) and values[i] is not None:
+                item[field] = values[i]
+        return item
+
+
+CODECS = dict(json=JsonCodec, msgpack=MsgpackCodec, table=TableCodec)
+
+
+class LRUCache(object):
+    """ A bounded mapping which evicts the least recently used entries, and
+    counts its hits and misses. A `maxsize` of 0 disables the cache.
+    """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data[key] = value
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = self.misses = 0
+
+    def stats(self):
+        return dict(hits=self.hits, misses=self.misses, size=len(self._data), maxsize=self.maxsize)
+
+
+class Analyzer(object):
+    """ Memoized tokenization shared by the index and the search paths. Cached
+    dicts are copied on the way out, as their consumers update them in place.
+    """
+    def __init__(self, cache_size=10000, max_prefix=None, dictionary=None):
+        self.max_prefix = max_prefix
+        self.dictionary = dictionary
+        self.loaded = False
+        self.segments = LRUCache(cache_size)
+        self.pinyin = LRUCache(cache_size)
+        self.queries = LRUCache(cache_size)
+
+    def load(self):
+        """ Load the tokenizer, once """
+        if not self.loaded:
+            load_tokenizer(self.dictionary)
+            self.loaded = True
+
+    def get_indexes(self, term):
+        if not self.loaded:
+            self.load()
+        return get_indexes(term, self.split_cn_word)
+
+    def split_cn_word(self, cn_word):
+        indexes = self.segments.get(cn_word)
+        if indexes is None:
+            indexes = split_cn_word(cn_word, self.max_prefix)
+            self.segments.set(cn_word, indexes)
+        return dict(indexes)
+
+    def to_pinyin(self, term):
+        """ Convert a query to pinyin """
+        pinyin = self.pinyin.get(term)
+        if pinyin is None:
+            from pypinyin import lazy_pinyin
+            if not self.loaded:
+                self.load()
+            pinyin = ''.join(lazy_pinyin(term))
+            self.pinyin.set(term, pinyin)
+        return pinyin
+
+    def search_term(self, term):
+        """ Convert a query to pinyin for a search. With `max_prefix`, the words longer
+        than it are replaced by their longest indexed prefix and the prefixes of their
+        segments, cut before the conversion as jieba does not split pinyin """
+        if not self.max_prefix:
+            return self.to_pinyin(term)
+        key = ('search', term)
+        converted = self.pinyin.get(key)
+        if converted is None:
+            import jieba
+            if not self.loaded:
+                self.load()
+            max_prefix = self.max_prefix
+            words = []
+            for word in term.split(' '):
+                pinyin = self.to_pinyin(word).lower()
+                candidates = [pinyin[:max_prefix]]
+                if len(pinyin) > max_prefix:
+                    candidates.extend(self.to_pinyin(seg).lower()[:max_prefix]
+                                      for seg in jieba.cut_for_search(word) if seg.strip())
+                words.extend(w for w in candidates if w and w not in words)
+            converted = ' '.join(words)
+            self.pinyin.set(key, converted)
+        return converted
+
+    def compile(self, query):
+        """ The index words of a query, as a tuple: lowercased, split on blanks and, with
+        `max_prefix`, bounded to indexed prefixes """
+        words = self.queries.get(query)
+        if words is None:
+            words = [w for w in query.lower().split(' ') if w]
+            if self.max_prefix:
+                words = self.bounded_words(words)
+            words = tuple(words)
+            self.queries.set(query, words)
+        return words
+
+    def bounded_words(self, words):
+        """ Replace the words longer than `max_prefix`, which have no prefix key, with
+        their longest indexed prefix and the prefixes of their segments """
+        import jieba
+        if not self.loaded:
+            self.load()
+        max_prefix = self.max_prefix
+        bounded = []
+        for word in words:
+            if len(word) <= max_prefix:
+                candidates = [word]
+            else:
+                candidates = [word[:max_prefix]]
+                candidates.extend(seg[:max_prefix] for seg in jieba.cut_for_search(word) if seg.strip())
+            bounded.extend(w for w in candidates if w not in bounded)
+        return bounded
+
+    def stats(self):
+        return dict(segments=self.segments.stats(), pinyin=self.pinyin.stats(), queries=self.queries.stats())
+
+
+_analyzer = None
+
+
+def load_tokenizer(dictionary=None):
+    """ Import jieba and pypinyin and load their data: the jieba dictionary, from the
+    prebuilt `dictionary` when given (see librorum.dictionary), the HMM model and the
+    pypinyin tables. The jieba dictionary is shared by the whole process. """
+    import jieba
+    from pypinyin import lazy_pinyin
+    if dictionary:
+        from .dictionary import load
+        load(dictionary)
+    else:
+        jieba.initialize()
+    list(jieba.cut_for_search(u'初始化'))
+    lazy_pinyin(u'初始化')
+
+
+def init_tokenizer(cache_size=10000, max_prefix=None, dictionary=None):
+    """ Load the jieba dictionary and pypinyin data, run once by every tokenizer worker """
+    global _analyzer
+    _analyzer = Analyzer(cache_size, max_prefix, dictionary)
+    _analyzer.load()
+
+
+def analyze(term):
+    """ get_indexes() through the analyzer of a tokenizer worker """
+    return _analyzer.get_indexes(term)
+
+
+def batch_terms(items):
+    """ The terms of `items`, lowercased as get_indexes() takes them """
+    return [(item.get('term') or '').lower() for item in items]
+
+
+def tokenizer_pool(workers, cache_size=10000, max_prefix=None, dictionary=None):
+    """ A process pool of `workers` tokenizers, see init_tokenizer() """
+    return ProcessPoolExecutor(workers, initializer=init_tokenizer, initargs=(cache_size, max_prefix, dictionary))
+
+
+def pool_indexes(pool, workers, terms):
+    """ An iterator of the get_indexes() results of `terms`, computed by the
+    tokenizer `pool` of `workers` processes """
+    return pool.map(analyze, terms, chunksize=max(1, len(terms) // (workers * 4)))
+
+
+def tokenized_batches(items, batch_size, workers=1, cache_size=10000, max_prefix=None, dictionary=None):
+    """ Yield (batch, indexes) pairs in input order, `indexes` being the
+    get_indexes() results of the batch terms. With more than one worker the
+    terms are tokenized by a process pool, one batch ahead of the consumer,
+    otherwise `indexes` is None and tokenization is left to the consumer.
+    """
+    if workers <= 1:
+        for batch in chunks(items, batch_size):
+            yield batch, None
+        return
+
+    with tokenizer_pool(workers, cache_size, max_prefix, dictionary) as pool:
+        pending = None
+        for batch in chunks(items, batch_size):
+            results = pool_indexes(pool, workers, batch_terms(batch))
+            if pending is not None:
+                yield pending[0], list(pending[1])
+            pending = (batch, results)
+        if pending is not None:
+            yield pending[0], list(pending[1])
 
 
-def get_indexes(term):
-    """ Get all the indexes of `term` """
+def get_indexes(term, split=None):
+    """ Get all the indexes of `term`, `split` replaces split_cn_word for the segments """
+    import jieba
+    split = split or split_cn_word
     cn_words = term.split(' ')
     _ = []
     for word in cn_words:
@@ -122,30 +1661,33 @@ def get_indexes(term):
 
     words_count = len(_)
 
-    words_indexes = multi(words_count)(merge_dicts_by_weight(map(split_cn_word, _)))
+    words_indexes = multi(words_count)(merge_dicts_by_weight(map(split, _)))
     return merge_dicts_by_weight([words_indexes, {''.join(cn_words): 1}])
 
 
-def split_cn_word(cn_word):
+def split_cn_word(cn_word, max_prefix=None):
     """ Get all the index-weight pairs of a Chinese word """
+    from pypinyin import lazy_pinyin, NORMAL
     pinyin_word = lazy_pinyin(cn_word, NORMAL)
     pinyin = ''.join(pinyin_word)
     py = ''.join(map(lambda x: x[0], pinyin_word))
 
-    word_indexes = split_word(cn_word)
-    pinyin_indexes = multi(2)(split_word(pinyin))
-    py_indexes = multi(3)(split_word(py))
+    word_indexes = split_word(cn_word, max_prefix)
+    pinyin_indexes = multi(2)(split_word(pinyin, max_prefix))
+    py_indexes = multi(3)(split_word(py, max_prefix))
 
     return merge_dicts_by_weight([word_indexes, pinyin_indexes, py_indexes])
 
 
-def split_word(word):
-    """ Get all the index-weight pairs of a word
+def split_word(word, max_prefix=None):
+    """ Get all the index-weight pairs of a word, prefixes longer
+    than `max_prefix` are left out but the whole word is kept
     """
     word_len = len(word)
     _ = {}
     for i in range(1, word_len+1):
-        _[word[:i]] = word_len/i
+        if max_prefix is None or i <= max_prefix or i == word_len:
+            _[word[:i]] = word_len/i
 
     return _
 
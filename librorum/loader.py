@@ -0,0 +1,164 @@
+# coding: utf-8
+""" Bulk loading of JSON lines files.
+
+The file is read, tokenized and written by three stages running concurrently,
+linked by bounded queues: a slow Redis stalls the tokenizer, which stalls the
+reader, so memory stays bounded whatever the size of the file. The byte offset
+of the last written batch is saved to a checkpoint file, from which an
+interrupted load resumes. Writes are idempotent, so the batches written after the
+last checkpoint are only written again.
+"""
+import json
+import os
+import queue
+import threading
+import time
+
+from .engine import batch_terms, pool_indexes, tokenizer_pool
+
+
+_DONE = object()
+
+
+def read_batches(path, batch_size, offset=0):
+    """ Yield the items of the JSON lines file `path` from the byte `offset` in
+    lists of `batch_size`, as (items, offset after the last item) """
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        batch = []
+        for line in iter(f.readline, b''):
+            offset += len(line)
+            line = line.strip()
+            if line:
+                batch.append(json.loads(line.decode('utf-8')))
+            if len(batch) >= batch_size:
+                yield batch, offset
+                batch = []
+        if batch:
+            yield batch, offset
+
+
+def read_checkpoint(checkpoint, path):
+    """ The offset saved by the last load of `path` to `checkpoint`, 0 if none """
+    try:
+        with open(checkpoint) as f:
+            state = json.load(f)
+    except (IOError, ValueError):
+        return 0
+    if state.get('path') != os.path.abspath(path):
+        return 0
+    return state['offset']
+
+
+def write_checkpoint(checkpoint, path, offset, items):
+    temp = '%s.tmp' % checkpoint
+    with open(temp, 'w') as f:
+        json.dump(dict(path=os.path.abspath(path), offset=offset, items=items), f)
+    os.replace(temp, checkpoint)
+
+
+def load(lib, path, batch_size=1000, workers=1, queue_size=4, checkpoint=None, checkpoint_every=10,
+         resume=True, callback=None):
+    """ Load the items of the JSON lines file `path` into `lib`.
+
+    batch_size: how many items are written per pipeline
+    workers: size of the tokenizer process pool, tokenization runs in a thread when 1
+    queue_size: how many batches each stage may get ahead of the next one
+    checkpoint: path of the checkpoint file, `<path>.checkpoint` by default
+    checkpoint_every: how many batches are written between two checkpoints
+    resume: start from the checkpoint, if any
+    callback: called as callback(stats) after each batch
+
+    The checkpoint is removed once the whole file is loaded. Returns the stats of
+    the load, a dict with `items`, `offset`, `seconds` and `rate` (items/sec).
+    """
+    if checkpoint is None:
+        checkpoint = '%s.checkpoint' % path
+    offset = read_checkpoint(checkpoint, path) if resume else 0
+
+    stop = threading.Event()
+    errors = []
+    parsed = queue.Queue(queue_size)
+    tokenized = queue.Queue(queue_size)
+
+    def put(target, value):
+        while not stop.is_set():
+            try:
+                target.put(value, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def stage(produce, target):
+        try:
+            for value in produce():
+                if not put(target, value):
+                    return
+        except BaseException as e:
+            errors.append(e)
+        finally:
+            put(target, _DONE)
+
+    def consume(source):
+        while not stop.is_set():
+            try:
+                value = source.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if value is _DONE:
+                return
+            yield value
+
+    def tokenize():
+        pool = None
+        if workers > 1:
+            pool = tokenizer_pool(workers, lib.config['cache_size'], lib.config['max_prefix'],
+                                  lib.config['dictionary'])
+        try:
+            for batch, end in consume(parsed):
+                terms = batch_terms(batch)
+                if pool is None:
+                    indexes = list(map(lib.analyzer.get_indexes, terms))
+                else:
+                    indexes = list(pool_indexes(pool, workers, terms))
+                yield batch, indexes, end
+        finally:
+            if pool is not None:
+                pool.shutdown()
+
+    threads = [threading.Thread(target=stage, args=(lambda: read_batches(path, batch_size, offset), parsed)),
+               threading.Thread(target=stage, args=(tokenize, tokenized))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    stats = dict(items=0, offset=offset, seconds=0, rate=0)
+    start = time.time()
+    written = 0
+    try:
+        for batch, indexes, end in consume(tokenized):
+            lib._write_batch(batch, indexes)
+            written += 1
+            stats['items'] += len(batch)
+            stats['offset'] = end
+            stats['seconds'] = time.time() - start
+            stats['rate'] = stats['items'] / stats['seconds'] if stats['seconds'] else float('inf')
+            if written % checkpoint_every == 0:
+                write_checkpoint(checkpoint, path, end, stats['items'])
+            if callback is not None:
+                callback(dict(stats))
+    except BaseException:
+        write_checkpoint(checkpoint, path, stats['offset'], stats['items'])
+        raise
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+    if errors:
+        write_checkpoint(checkpoint, path, stats['offset'], stats['items'])
+        raise errors[0]
+    if os.path.exists(checkpoint):
+        os.remove(checkpoint)
+    return stats
@@ -0,0 +1,169 @@
+# coding: utf-8
+""" Instrumentation of Librorum.
+
+A metrics sink is any object with two methods:
+
+    timing(stage, seconds): the duration of a stage, such as `search` or `retrieve.intersect`
+    count(name, value): a measure of a stage, such as `search.roundtrips` or `retrieve.cardinality`
+
+and is given to Librorum by config `metrics`.
+"""
+import threading
+import time
+from bisect import bisect_left
+from collections import defaultdict
+
+
+class NullStage(object):
+    """ What Librorum times its stages with when no sink is configured """
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+NULL_STAGE = NullStage()
+
+
+class Stage(object):
+    """ Report the duration of a stage, and the round-trips it made to `connection` """
+    __slots__ = ('sink', 'name', 'connection', 'start', 'roundtrips')
+
+    def __init__(self, sink, name, connection=None):
+        self.sink = sink
+        self.name = name
+        self.connection = connection
+
+    def __enter__(self):
+        if self.connection is not None:
+            self.roundtrips = self.connection.roundtrips
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.sink.timing(self.name, time.time() - self.start)
+        if self.connection is not None:
+            self.sink.count('%s.roundtrips' % self.name, self.connection.roundtrips - self.roundtrips)
+        return False
+
+
+class CountingConnection(object):
+    """ Proxy of a Redis connection counting the round-trips of the current thread:
+    one per command, pipeline execution or script call """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self._local = threading.local()
+
+    @property
+    def roundtrips(self):
+        return getattr(self._local, 'roundtrips', 0)
+
+    def _count(self):
+        self._local.roundtrips = self.roundtrips + 1
+
+    def __getattr__(self, name):
+        # only what the connection has, so hasattr() tells whether it supports scripts
+        attr = getattr(self.connection, name)
+        if name == 'register_script':
+            return self._register_script
+        if not callable(attr):
+            return attr
+
+        def command(*args, **kwargs):
+            self._count()
+            return attr(*args, **kwargs)
+        return command
+
+    def pipeline(self, *args, **kwargs):
+        return CountingPipeline(self, self.connection.pipeline(*args, **kwargs))
+
+    def _register_script(self, script):
+        registered = self.connection.register_script(script)
+
+        def call(*args, **kwargs):
+            self._count()
+            return registered(*args, **kwargs)
+        return call
+
+    def scan_iter(self, *args, **kwargs):
+        return self.connection.scan_iter(*args, **kwargs)
+
+
+class CountingPipeline(object):
+    def __init__(self, counter, pipeline):
+        self.counter = counter
+        self.pipeline = pipeline
+
+    def __getattr__(self, name):
+        return getattr(self.pipeline, name)
+
+    def execute(self, *args, **kwargs):
+        self.counter._count()
+        return self.pipeline.execute(*args, **kwargs)
+
+
+class Histogram(object):
+    """ Counts of values in exponential buckets, upper bounds included """
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.buckets = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def record(self, value):
+        self.buckets[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def percentile(self, p):
+        """ Upper bound of the bucket holding the `p` percentile """
+        rank = self.count * p / 100.0
+        seen = 0
+        for bound, count in zip(self.bounds + [self.max], self.buckets):
+            seen += count
+            if count and seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def stats(self):
+        return dict(count=self.count, sum=self.total, min=self.min, max=self.max,
+                    mean=self.total / self.count if self.count else None,
+                    p50=self.percentile(50), p95=self.percentile(95), p99=self.percentile(99))
+
+
+class HistogramSink(object):
+    """ In-memory sink keeping a histogram per stage timing and per count """
+    TIMING_BOUNDS = [1e-6 * 2 ** i for i in range(32)]
+    COUNT_BOUNDS = [2 ** i for i in range(48)]
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def timing(self, stage, seconds):
+        with self._lock:
+            self.timings[stage].record(seconds)
+
+    def count(self, name, value):
+        with self._lock:
+            self.counts[name].record(value)
+
+    def reset(self):
+        with self._lock:
+            self.timings = defaultdict(lambda: Histogram(self.TIMING_BOUNDS))
+            self.counts = defaultdict(lambda: Histogram(self.COUNT_BOUNDS))
+
+    def snapshot(self):
+        """ The stats of every histogram, as {'timings': {stage: stats}, 'counts': {name: stats}} """
+        with self._lock:
+            return dict(timings=dict((name, h.stats()) for name, h in self.timings.items()),
+                        counts=dict((name, h.stats()) for name, h in self.counts.items()))
@@ -0,0 +1,138 @@
+# coding: utf-8
+import time
+import zlib
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from heapq import merge
+from itertools import islice
+
+from .engine import Librorum, query_args, rank_range, tokenized_batches
+
+
+class ShardedLibrorum(object):
+    """ Librorum partitioned by uid across several Redis connections.
+
+    Every connection holds a shard: a Librorum whose engine name is the hash tag
+    `{<engine_name>:<i>}`, so all the keys of a shard live in one Redis Cluster
+    slot and its intersections stay on one node. Writes go to the shard of their
+    uid. Queries run on every shard in parallel, each shard ranking its own top
+    results, which are merged by (score, uid) like a single ZRANGE would order
+    them, so `limit` and `offset` mean the same as with Librorum.
+
+    Other config entries are the ones of Librorum, given to every shard.
+    """
+
+    def __init__(self, connections, **kwargs):
+        engine_name = kwargs.pop('engine_name', '')
+        self.config = dict(kwargs, engine_name=engine_name)
+        self.shards = [Librorum(connection, engine_name='{%s:%d}' % (engine_name, i), **kwargs)
+                       for i, connection in enumerate(connections)]
+        if not self.shards:
+            raise Exception('ShardedLibrorum needs at least one connection')
+        self._executor = ThreadPoolExecutor(len(self.shards))
+
+    def shard(self, uid):
+        """ The shard holding the item `uid` """
+        return self.shards[zlib.crc32(str(uid).encode('utf-8')) % len(self.shards)]
+
+    def _partition(self, items, uid=lambda item: item['uid']):
+        """ Group `items` by shard, as {shard: [items]} """
+        partitions = defaultdict(list)
+        for item in items:
+            partitions[self.shard(uid(item))].append(item)
+        return partitions
+
+    def _map(self, func, args):
+        """ Call func(shard, arg) for every (shard, arg) pair of `args` in parallel, in order """
+        futures = [self._executor.submit(func, shard, arg) for shard, arg in args]
+        return [future.result() for future in futures]
+
+    def warmup(self):
+        """ Same as Librorum.warmup """
+        for shard in self.shards:
+            shard.warmup()
+
+    def search(self, term, fields=None, **kwargs):
+        """ Same as Librorum.search, the documents are fetched from every shard in parallel """
+        term = self.shards[0].analyzer.search_term(term)
+        uids = self.retrieve(term, **kwargs)
+        if not uids:
+            return []
+
+        partitions = self._partition(uids, uid=lambda uid: uid)
+        fetched = self._map(lambda shard, uids: shard.redis.hmget(shard.database, *uids), partitions.items())
+        docs = {}
+        for (shard, shard_uids), raws in zip(partitions.items(), fetched):
+            found = [(uid, raw) for uid, raw in zip(shard_uids, raws) if raw is not None]
+            docs.update(zip([uid for uid, _ in found], shard._decode([raw for _, raw in found], fields)))
+        return [docs[uid] for uid in uids if uid in docs]
+
+    def search_many(self, queries):
+        """ Same as Librorum.search_many """
+        return [self.search(term, **kwargs) for term, kwargs in map(query_args, queries)]
+
+    def retrieve(self, word, limit=0, offset=0, **kwargs):
+        """ Same as Librorum.retrieve """
+        return [uid for uid, _ in self.retrieve_scored(word, limit, offset, **kwargs)]
+
+    def retrieve_scored(self, word, limit=0, offset=0, **kwargs):
+        """ Same as Librorum.retrieve_scored. Every shard returns its results ranked
+        before `limit`, all of them with no limit or negative ranks. """
+        top = limit if limit > 0 and offset >= 0 else 0
+        ranked = self._map(lambda shard, _: shard.retrieve_scored(word, top, 0, **kwargs),
+                           [(shard, None) for shard in self.shards])
+        merged = merge(*ranked, key=lambda pair: (pair[1], str(pair[0])))
+        if top:
+            return list(islice(merged, offset, top))
+        return rank_range(list(merged), offset, limit-1)
+
+    def add_item(self, item):
+        """ Same as Librorum.add_item """
+        self.shard(item['uid']).add_item(item)
+
+    def update_item(self, item):
+        """ Same as Librorum.update_item """
+        self.shard(item['uid']).update_item(item)
+
+    def store(self, item, uid=None):
+        self.shard(uid or item.get('uid')).store(item, uid)
+
+    def add_items(self, items, batch_size=1000, callback=None, workers=None):
+        """ Same as Librorum.add_items, every batch being tokenized by one process pool
+        for all the shards, then split across the shards and written to them in parallel """
+        config = self.shards[0].config
+        if workers is None:
+            workers = config['workers']
+
+        stats = []
+        done = 0
+        start = time.time()
+        for batch, indexes in tokenized_batches(items, batch_size, workers, config['cache_size'],
+                                                config['max_prefix'], config['dictionary']):
+            if indexes is None:
+                partitions = self._partition(batch).items()
+                self._map(lambda shard, items: shard._write_batch(items), partitions)
+            else:
+                partitions = self._partition(zip(batch, indexes), uid=lambda pair: pair[0]['uid']).items()
+                self._map(lambda shard, pairs: shard._write_batch(*zip(*pairs)), partitions)
+            seconds = time.time() - start
+            batch_stats = dict(items=len(batch), seconds=seconds,
+                               rate=len(batch) / seconds if seconds else float('inf'))
+            stats.append(batch_stats)
+            done += len(batch)
+            if callback is not None:
+                callback(done, batch_stats)
+            start = time.time()
+        return stats
+
+    def del_item(self, uid):
+        """ Same as Librorum.del_item """
+        self.shard(uid).del_item(uid)
+
+    def del_items(self, uids):
+        """ Same as Librorum.del_items """
+        self._map(lambda shard, uids: shard.del_items(uids), self._partition(uids, uid=lambda uid: uid).items())
+
+    def flush(self, count=1000):
+        """ Same as Librorum.flush, on every shard """
+        self._map(lambda shard, _: shard.flush(count), [(shard, None) for shard in self.shards])
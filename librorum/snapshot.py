@@ -0,0 +1,229 @@
+# coding: utf-8
+""" Offline index builds.
+
+build() indexes a corpus into the in-memory backend, with the same code and
+config as a live engine, and saves the finished keys to a snapshot file: no
+Redis is involved. restore() then writes a snapshot to an engine with pipelined
+bulk commands, so the heavy indexing runs on batch machines and the production
+load is short and predictable.
+
+A snapshot is a gzip stream starting with MAGIC and a JSON header, followed by
+one record per chunk of a sorted set, set or hash. Key names are stored relative
+to the namespace, so a snapshot restores to any engine name or version.
+"""
+import gzip
+import json
+import struct
+import sys
+import time
+from array import array
+
+from .backends import MemoryBackend
+from .engine import Librorum
+
+
+MAGIC = b'LIBRORUM-SNAPSHOT-1\n'
+RECORD = struct.Struct('<cIIQ')     # kind, key length, entry count, payload length
+CHUNK = 10000                       # entries per record, and per pipeline on restore
+KINDS = {b'zset': b'z', b'set': b's', b'hash': b'h'}
+
+
+def _pack(values, typecode='I'):
+    """ `values` as a little-endian array of `typecode` """
+    values = array(typecode, values)
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values.tobytes()
+
+
+def _unpack(typecode, payload, offset, count):
+    values = array(typecode)
+    values.frombytes(payload[offset:offset + values.itemsize * count])
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values, offset + values.itemsize * count
+
+
+def _pack_strings(strings):
+    return _pack(map(len, strings)) + b''.join(strings)
+
+
+def _unpack_strings(payload, offset, count):
+    lengths, offset = _unpack('I', payload, offset, count)
+    strings = []
+    for length in lengths:
+        strings.append(payload[offset:offset + length])
+        offset += length
+    return strings, offset
+
+
+def _entries(redis, key, kind):
+    """ Yield the entries of `key` in chunks: (member, score) pairs of a sorted set,
+    members of a set, (field, value) pairs of a hash """
+    if kind == b'z':
+        start = 0
+        while True:
+            chunk = redis.zrange(key, start, start + CHUNK - 1, withscores=True)
+            if chunk:
+                yield chunk
+            if len(chunk) < CHUNK:
+                return
+            start += CHUNK
+    elif kind == b's':
+        members = list(redis.smembers(key))
+        for start in range(0, len(members), CHUNK):
+            yield members[start:start + CHUNK]
+    else:
+        chunk = []
+        for entry in redis.hscan_iter(key, count=CHUNK):
+            chunk.append(entry)
+            if len(chunk) >= CHUNK:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+
+def _encode(value):
+    return value if isinstance(value, bytes) else str(value).encode('utf-8')
+
+
+def _payload(kind, entries):
+    if kind == b'z':
+        return _pack_strings([_encode(member) for member, _ in entries]) + \
+            _pack((score for _, score in entries), 'd')
+    if kind == b's':
+        return _pack_strings([_encode(member) for member in entries])
+    return _pack_strings([_encode(field) for field, _ in entries]) + \
+        _pack_strings([_encode(value) for _, value in entries])
+
+
+def header(lib):
+    """ The config of `lib` a snapshot depends on """
+    config = lib.config
+    return dict(namespace=lib.namespace, created=time.time(), codec=config['codec'],
+                table_fields=config['table_fields'], max_prefix=config['max_prefix'],
+                structure=dict((k, getattr(kind, '__name__', str(kind))) for k, kind in config['structure'].items()))
+
+
+def _settings(meta):
+    """ The settings of the header `meta` an engine must share to serve the snapshot,
+    the table fields being the effective ones of codec `table` """
+    fields = None
+    if meta['codec'] == 'table':
+        fields = meta['table_fields'] or ['uid', 'term'] + sorted(meta['structure'])
+    return dict(table_fields=fields, structure=meta['structure'], max_prefix=meta['max_prefix'])
+
+
+def dump(lib, path, compresslevel=6):
+    """ Save the index of `lib` to the snapshot file `path`, result keys left out.
+    Returns the stats of the snapshot, a dict with `keys`, `entries` and `bytes`.
+    """
+    namespace = lib.namespace
+    excluded = (lib.resultbase.encode(), lib.generation.encode())
+    stats = dict(keys=0, entries=0, bytes=0)
+    with gzip.open(path, 'wb', compresslevel=compresslevel) as f:
+        meta = json.dumps(header(lib)).encode('utf-8')
+        f.write(MAGIC + struct.pack('<I', len(meta)) + meta)
+        for key in lib.redis.scan_iter(match='%s_*' % namespace, count=CHUNK):
+            key = _encode(key)
+            if key.startswith(excluded):
+                continue
+            kind = KINDS.get(_encode(lib.redis.type(key)))
+            if kind is None:
+                continue
+            suffix = key[len(namespace):]
+            stats['keys'] += 1
+            for entries in _entries(lib.redis, key, kind):
+                payload = _payload(kind, entries)
+                f.write(RECORD.pack(kind, len(suffix), len(entries), len(payload)) + suffix + payload)
+                stats['entries'] += len(entries)
+    with open(path, 'rb') as f:
+        f.seek(0, 2)
+        stats['bytes'] = f.tell()
+    return stats
+
+
+def read(path):
+    """ The header of the snapshot file `path`, and a generator of its records as
+    (kind, key suffix, entries), see _entries() for the entries of each kind """
+    f = gzip.open(path, 'rb')
+    if f.read(len(MAGIC)) != MAGIC:
+        f.close()
+        raise Exception('%s is not a Librorum snapshot' % path)
+    length, = struct.unpack('<I', f.read(4))
+    meta = json.loads(f.read(length).decode('utf-8'))
+
+    def records():
+        with f:
+            while True:
+                head = f.read(RECORD.size)
+                if not head:
+                    return
+                kind, key_length, count, payload_length = RECORD.unpack(head)
+                suffix = f.read(key_length).decode('utf-8')
+                payload = f.read(payload_length)
+                members, offset = _unpack_strings(payload, 0, count)
+                if kind == b'z':
+                    scores, _ = _unpack('d', payload, offset, count)
+                    yield kind, suffix, dict(zip(members, scores))
+                elif kind == b's':
+                    yield kind, suffix, members
+                else:
+                    values, _ = _unpack_strings(payload, offset, count)
+                    yield kind, suffix, dict(zip(members, values))
+    return meta, records()
+
+
+def restore(lib, path, flush=True):
+    """ Write the snapshot file `path` to the index of `lib`, by pipelines of about
+    CHUNK entries. The index is flushed first unless `flush` is False. To replace a
+    live index, restore to a version from lib.rebuild() and publish it.
+    Returns the stats of the restore, a dict with `keys`, `entries` and `seconds`.
+    """
+    start = time.time()
+    meta, records = read(path)
+    if meta['codec'] != lib.config['codec']:
+        raise Exception('the snapshot documents are encoded by codec %s, not %s'
+                        % (meta['codec'], lib.config['codec']))
+    found, expected = _settings(meta), _settings(json.loads(json.dumps(header(lib))))
+    for name in sorted(found):
+        if found[name] != expected[name]:
+            raise Exception('the snapshot was built with %s %r, not %r' % (name, found[name], expected[name]))
+    if flush:
+        lib.flush()
+
+    namespace = lib.namespace
+    stats = dict(keys=0, entries=0, seconds=0)
+    pipe = lib.redis.pipeline(transaction=False)
+    queued = 0
+    last = None
+    for kind, suffix, entries in records:
+        key = namespace + suffix
+        if kind == b'z':
+            pipe.zadd(key, entries)
+        elif kind == b's':
+            pipe.sadd(key, *entries)
+        else:
+            pipe.hset(key, mapping=entries)
+        stats['keys'] += key != last
+        stats['entries'] += len(entries)
+        last = key
+        queued += len(entries)
+        if queued >= CHUNK:
+            pipe.execute()
+            queued = 0
+    pipe.incr(lib.generation)
+    pipe.execute()
+    stats['seconds'] = time.time() - start
+    return stats
+
+
+def build(items, path, batch_size=1000, workers=1, **config):
+    """ Index `items` offline and save the index to the snapshot file `path`.
+    `config` is the config of the engines the snapshot is for, such as `structure`,
+    `max_prefix` or `codec`. Returns the stats of dump().
+    """
+    lib = Librorum(MemoryBackend(), **dict(config, versioned=False))
+    lib.add_items(items, batch_size, workers=workers)
+    return dump(lib, path)
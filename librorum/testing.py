@@ -1,7 +1,25 @@
 # coding: utf-8
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
 import unittest
+from concurrent.futures import ThreadPoolExecutor
 import redis
-from engine import Librorum, get_indexes, split_cn_word, split_word, merge_dicts_by_weight
+import redis.asyncio
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from librorum.engine import (Librorum, Analyzer, LRUCache, TableCodec, get_indexes,  # noqa: E402
+                             split_cn_word, split_word, merge_dicts_by_weight, msgpack)
+from librorum.aio import AsyncLibrorum  # noqa: E402
+from librorum.backends import MemoryBackend  # noqa: E402
+from librorum.sharded import ShardedLibrorum  # noqa: E402
+from librorum.loader import load  # noqa: E402
+from librorum import snapshot  # noqa: E402
+from librorum import dictionary  # noqa: E402
+from librorum.metrics import HistogramSink  # noqa: E402
 
 
 items = [
@@ -24,6 +42,18 @@ item, item2, item3, item4, item5, item6, item7, item8, item9, item10, item11, it
 LIMIT = 3
 
 
+def index_contents(lib):
+    """ Members of every index key of `lib`, by key suffix """
+    contents = {}
+    for key in lib.redis.keys('%s*' % lib.indexbase):
+        if lib.redis.type(key) == b'zset':
+            members = lib.redis.zrange(key, 0, -1, withscores=True)
+        else:
+            members = lib.redis.smembers(key)
+        contents[key[len(lib.indexbase):]] = members
+    return contents
+
+
 class TestUtilities(unittest.TestCase):
 
     def test_merge_dicts_by_weight(self):
@@ -37,6 +67,7 @@ class TestUtilities(unittest.TestCase):
     def test_split_word(self):
         self.assertIn(u'大学', split_word(u'大学').keys())
         self.assertIn(u'清华大学', split_word(u'清华大学').keys())
+        self.assertEqual(set(split_word(u'qinghua', 3)), set([u'q', u'qi', u'qin', u'qinghua']))
 
     def test_split_cn_word(self):
         term = u'清华大学'
@@ -64,10 +95,113 @@ class TestUtilities(unittest.TestCase):
         self.assertLess(baidu_indexes[u'百度'], baidu_indexes[u'baidu'])
         self.assertLess(baidu_indexes[u'baidu'], baidu_indexes[u'bd'])
 
+    def test_lru_cache(self):
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('c', 3)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('c'), 3)
+        self.assertEqual(cache.stats(), dict(hits=2, misses=1, size=2, maxsize=2))
+
+        disabled = LRUCache(0)
+        disabled.set('a', 1)
+        self.assertIsNone(disabled.get('a'))
+
+    def test_analyzer(self):
+        analyzer = Analyzer(100)
+        for term in [u'北京大学', u'北京', u'qsinghua大学']:
+            self.assertEqual(analyzer.get_indexes(term), get_indexes(term))
+            self.assertEqual(analyzer.get_indexes(term), get_indexes(term))
+        self.assertGreater(analyzer.stats()['segments']['hits'], 0)
+
+        analyzer.split_cn_word(u'百度')[u'百度'] = 100
+        self.assertEqual(analyzer.split_cn_word(u'百度'), split_cn_word(u'百度'))
+
+        self.assertEqual(analyzer.to_pinyin(u'北京'), 'beijing')
+        self.assertEqual(analyzer.to_pinyin(u'北京'), 'beijing')
+        self.assertEqual(analyzer.stats()['pinyin']['hits'], 1)
+
+    def test_table_codec(self):
+        codec = TableCodec(['uid', 'term', 't', 'n'])
+        for item in items + [dict(uid=14, term=u'清华', n=2, tags=[u'大学'])]:
+            raw = codec.encode(item).encode('utf-8')
+            self.assertEqual(codec.decode(raw), item)
+            self.assertEqual(codec.decode(raw, ['term', 'n', 'tags']),
+                             dict((k, item[k]) for k in ('term', 'n', 'tags') if k in item))
+        self.assertEqual(codec.encode(dict(uid=1, term=u'北京', t=0)), u'[1,"北京",0]')
+
+    def test_lazy_tokenizer(self):
+        script = 'import sys, librorum; print(sorted(set(["jieba", "pypinyin"]) & set(sys.modules)))'
+        output = subprocess.check_output([sys.executable, '-c', script],
+                                         cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        self.assertEqual(output.decode().strip(), '[]')
+
+        lib = Librorum(MemoryBackend())
+        lib.warmup()
+        self.assertTrue(lib.analyzer.loaded)
+
+    def test_dictionary(self):
+        import jieba
+        directory = tempfile.mkdtemp()
+        userdict = os.path.join(directory, 'words.txt')
+        with open(userdict, 'w', encoding='utf-8') as f:
+            f.write(u'鸟巢剧场 10 n\n')
+        path = os.path.join(directory, 'jieba.dict')
+        dictionary.build(path, userdicts=[userdict])
+
+        tokenizer = dictionary.load(path, jieba.Tokenizer())
+        self.assertIn(u'鸟巢剧场', tokenizer.lcut(u'去鸟巢剧场'))
+        self.assertEqual(tokenizer.lcut(u'北京大学'), jieba.lcut(u'北京大学'))
+        os.remove(path)
+        os.remove(userdict)
+        os.rmdir(directory)
+
+    def test_histogram_sink(self):
+        sink = HistogramSink()
+        for value in [0.001] * 98 + [0.5, 2]:
+            sink.timing('search', value)
+        sink.count('search.roundtrips', 2)
+        snapshot = sink.snapshot()
+        search = snapshot['timings']['search']
+        self.assertEqual(search['count'], 100)
+        self.assertLessEqual(search['p50'], 0.002)
+        self.assertGreaterEqual(search['p50'], 0.001)
+        self.assertGreaterEqual(search['p99'], 0.5)
+        self.assertLess(search['p99'], 1)
+        self.assertEqual(search['max'], 2)
+        self.assertEqual(snapshot['counts']['search.roundtrips']['p50'], 2)
+
+    def test_sorted_set(self):
+        backend = MemoryBackend()
+        expected = {}
+        for batch in [dict((b'%d' % i, float(i % 7)) for i in range(200)),
+                      dict((b'%d' % i, float(i % 5)) for i in range(0, 300, 3)),
+                      {b'5': 1.0, b'500': 0.5}]:
+            added = len(set(batch) - set(expected))
+            expected.update(batch)
+            self.assertEqual(backend.zadd('z', batch), added)
+        ordered = sorted(expected.items(), key=lambda entry: (entry[1], entry[0]))
+        self.assertEqual(backend.zrange('z', 0, -1, withscores=True), ordered)
+        self.assertEqual(backend.zmscore('z', [b'3', b'6', b'x']), [expected[b'3'], expected[b'6'], None])
+        self.assertEqual(backend.zadd('z', {b'3': 1.5, b'x': 1}, xx=True), 0)
+        self.assertEqual(backend.zscore('z', b'3'), 1.5)
+        self.assertEqual(backend.zrem('z', b'3', b'x'), 1)
+        self.assertEqual(backend.zcard('z'), len(expected) - 1)
+
+        backend.sadd('s', *[b'%d' % i for i in range(0, 300, 2)])
+        even = [member for member in expected if int(member) % 2 == 0 and int(member) < 300]
+        self.assertEqual(backend.zinterstore('i', dict(z=2, s=1)), len(even))
+        self.assertEqual(backend.zscore('i', b'6'), 2 * expected[b'6'] + 1)
+
 
 class TestEngine(unittest.TestCase):
+    def connect(self):
+        return redis.StrictRedis()
+
     def setUp(self):
-        r = redis.StrictRedis()
+        r = self.connect()
         structure = dict(t=int, n=int)
         self.structure = structure
         self.lib = Librorum(r, structure=structure)
@@ -158,13 +292,724 @@ class TestEngine(unittest.TestCase):
         beijing_result = self.lib.retrieve('beijing', limit=LIMIT)
         assert len(beijing_result) <= LIMIT
 
+    def test_add_items(self):
+        expected = dict((term, self.lib.retrieve(term)) for term in ['b', 'q', u'百度', 'bjdx'])
+        self.lib.flush()
+
+        progress = []
+        stats = self.lib.add_items(iter(items), batch_size=5,
+                                   callback=lambda done, batch: progress.append(done))
+        self.assertEqual(progress, [5, 10, 12])
+        self.assertEqual([batch['items'] for batch in stats], [5, 5, 2])
+        for term, uids in expected.items():
+            self.assertSequenceEqual(self.lib.retrieve(term), uids)
+        self.assertEqual(self.lib.search(u'百度')[0], item7)
+
+    def test_add_items_workers(self):
+        expected = dict((term, self.lib.retrieve(term)) for term in ['b', 'q', u'百度', 'bjdx'])
+        self.lib.flush()
+
+        stats = self.lib.add_items(items, batch_size=4, workers=2)
+        self.assertEqual(sum(batch['items'] for batch in stats), len(items))
+        for term, uids in expected.items():
+            self.assertSequenceEqual(self.lib.retrieve(term), uids)
+
+    def test_retrieve_leaves_no_result_keys(self):
+        self.lib.retrieve(u'qinghua', t=1)
+        self.lib.retrieve(u'bj')
+        self.assertEqual(self.lib.redis.keys('%s*' % self.lib.resultbase), [])
+
+    def test_cached_retrieve(self):
+        lib = Librorum(self.lib.redis, structure=self.structure, cached=True, cache_ttl=30)
+        expected = self.lib.retrieve(u'bj', t=0)
+        self.assertSequenceEqual(lib.retrieve(u'bj', t=0), expected)
+        self.assertSequenceEqual(lib.retrieve(u'bj', t=0), expected)
+        self.assertSequenceEqual(lib.retrieve(u'bj', limit=3, offset=1, t=0), expected[1:3])
+
+        result_keys = lib.redis.keys('%s*' % lib.resultbase)
+        self.assertEqual(len(result_keys), 1)
+        self.assertLessEqual(lib.redis.ttl(result_keys[0]), 30)
+        self.assertGreater(lib.redis.ttl(result_keys[0]), 0)
+
+        lib.add_item(dict(uid=13, term=u'北京交通大学', t=0))
+        self.assertIn(13, lib.retrieve(u'bj', t=0))
+        self.assertNotIn(13, lib.retrieve(u'bj', t=1))
+
+    def test_concurrent_retrieve(self):
+        queries = [(u'b', {}), (u'b', dict(t=0)), (u'b', dict(t=1)), (u'bj', dict(n=4)), (u'q', dict(t=1))] * 20
+        expected = [self.lib.retrieve(word, **kwargs) for word, kwargs in queries]
+        for lib in (self.lib, Librorum(self.lib.redis, structure=self.structure, planner=False)):
+            with ThreadPoolExecutor(8) as executor:
+                results = list(executor.map(lambda query: lib.retrieve(query[0], **query[1]), queries))
+            self.assertEqual(results, expected)
+        self.assertEqual(self.lib.redis.keys('%s*' % self.lib.resultbase), [])
+
+    def test_search_many(self):
+        queries = [u'beijing', dict(term=u'qh', t=1), dict(term='b', limit=2), u'zzz']
+        expected = [self.lib.search(u'beijing'), self.lib.search(u'qh', t=1), self.lib.search('b', limit=2), []]
+        self.assertEqual(self.lib.search_many(queries), expected)
+        self.assertEqual(self.lib.search_many([]), [])
+
+    def test_retrieve_page(self):
+        expected = self.lib.retrieve('b')
+        uids, cursor = self.lib.retrieve_page('b', count=2)
+        self.assertEqual(uids, expected[:2])
+        pages = [uids]
+        while cursor is not None:
+            uids, cursor = self.lib.retrieve_page('b', cursor, count=2)
+            pages.append(uids)
+        self.assertEqual(sum(pages, []), expected)
+        self.assertEqual(self.lib.redis.keys('%s*' % self.lib.resultbase), [])
+
+        uids, cursor = self.lib.retrieve_page('b', count=3, t=0)
+        self.lib.redis.delete(*self.lib.redis.keys('%s*' % self.lib.resultbase))
+        self.assertEqual(uids + self.lib.retrieve_page('b', cursor, count=100, t=0)[0], self.lib.retrieve('b', t=0))
+        self.assertEqual(self.lib.retrieve_page('zzz'), ([], None))
+
+    def test_iter_search(self):
+        self.assertEqual(list(self.lib.iter_retrieve('b', chunk_size=2)), self.lib.retrieve('b'))
+        self.assertEqual(list(self.lib.iter_search('b', chunk_size=3, t=0)), self.lib.search('b', t=0))
+        self.assertEqual(list(self.lib.iter_search(u'北京', fields=['uid'])),
+                         [dict(uid=item['uid']) for item in self.lib.search(u'北京')])
+
+        uids = self.lib.iter_retrieve('b', chunk_size=2)
+        next(uids)
+        self.assertEqual(len(self.lib.redis.keys('%s*' % self.lib.resultbase)), 1)
+        uids.close()
+        self.assertEqual(self.lib.redis.keys('%s*' % self.lib.resultbase), [])
+
+    def test_range_filters(self):
+        with_n = [uid for uid in self.lib.retrieve('b') if 'n' in items[uid - 1]]
+        self.assertEqual(self.lib.retrieve('b', t__gte=1), self.lib.retrieve('b', t=1))
+        self.assertEqual(self.lib.retrieve('b', t__lt=1), self.lib.retrieve('b', t=0))
+        self.assertEqual(self.lib.retrieve('b', n__gte=4, n__lte=4), with_n)
+        self.assertEqual(self.lib.retrieve('b', n__gte=0, limit=2, offset=1), with_n[1:2])
+        self.assertEqual(self.lib.retrieve('b', n__gt=4), [])
+        self.assertEqual(self.lib.search('b', t__gte=1), self.lib.search('b', t=1))
+
+        self.lib.update_item(dict(item5, n=9))
+        self.assertEqual(self.lib.retrieve('bj', n__gt=4), [5])
+        self.assertEqual(self.lib.retrieve('bj', n__gt=4, n__lt=9), [])
+        self.assertEqual(self.lib.retrieve('bj', n__gt=4, t=0), [5])
+        for lib in (Librorum(self.lib.redis, structure=self.structure, cached=True),
+                    Librorum(self.lib.redis, structure=self.structure, scripted=True)):
+            self.assertEqual(lib.retrieve('bj', n__gt=4), [5])
+            self.assertEqual(lib.search('bj', n__gt=4), [dict(item5, n=9)])
+            self.assertEqual(lib.search('b', n__lte=4, t=0), self.lib.search('b', n=4, t=0))
+        self.assertEqual(list(self.lib.iter_retrieve('b', chunk_size=2, n__lt=9)), [uid for uid in with_n if uid != 5])
+
+        self.lib.del_item(5)
+        self.assertEqual(self.lib.retrieve('bj', n__gt=4), [])
+        self.assertEqual(self.lib.redis.keys('%s_tmp_*' % self.lib.resultbase), [])
+        with self.assertRaises(Exception):
+            self.lib.retrieve('b', term__gt=1)
+
+    def test_scripted_search(self):
+        for cached in (False, True):
+            lib = Librorum(self.lib.redis, structure=self.structure, scripted=True, cached=cached)
+            for term, kwargs in [(u'beijing', {}), (u'北京', dict(t=0)), ('b', dict(limit=LIMIT)),
+                                 ('b', dict(limit=0, offset=2)), (u'qsing daxue', dict(t=1)), ('zzz', {})]:
+                self.assertEqual(lib.search(term, **kwargs), self.lib.search(term, **kwargs))
+                self.assertEqual(lib.search(term, **kwargs), self.lib.search(term, **kwargs))
+        self.assertEqual(len(self.lib.redis.keys('%s_0_*' % self.lib.resultbase)), 0)
+
+    def test_del_item(self):
+        keys = set(self.lib.redis.keys('%s*' % self.lib.indexbase))
+        self.lib.add_item(dict(uid=13, term=u'呼和浩特', t=1, n=9))
+        self.assertIn(13, self.lib.retrieve(u'hhht', t=1))
+
+        self.lib.del_item(13)
+        self.assertEqual(self.lib.retrieve(u'hhht'), [])
+        self.assertEqual(set(self.lib.redis.keys('%s*' % self.lib.indexbase)), keys)
+        self.assertFalse(self.lib.redis.hexists(self.lib.database, 13))
+        self.assertFalse(self.lib.redis.hexists(self.lib.reverse, 13))
+
+    def test_del_items(self):
+        self.lib.del_items([item7['uid'], item8['uid']])
+        self.assertSequenceEqual(self.lib.retrieve(u'百度'), [item10['uid'], item9['uid']])
+        self.assertNotIn(item8['uid'], self.lib.retrieve(u'tz'))
+        self.assertEqual(self.lib.search(u'百度'), [item10, item9])
+
+    def test_sweep(self):
+        self.lib.redis.hdel(self.lib.reverse, item12['uid'])
+        self.lib.del_item(item12['uid'])
+        self.assertIn(item12['uid'], self.lib.retrieve(u'qingniao'))
+        self.assertEqual(self.lib.search(u'qingniao'), [])
+        self.assertEqual(list(self.lib.iter_search(u'qingniao')), [])
+        self.assertEqual(self.lib.typeahead(u'qingniao'), [])
+
+        cursor = self.lib.sweep(count=10)
+        while cursor:
+            cursor = self.lib.sweep(cursor, count=10)
+        self.assertEqual(self.lib.retrieve(u'qingniao'), [])
+        self.assertNotIn(item12['uid'], self.lib.retrieve(u'bd'))
+        self.assertIn(item11['uid'], self.lib.retrieve(u'bd'))
+
+        # a large key is walked over several steps of about `count` members
+        self.lib.add_items([dict(uid=100 + i, term=u'zzz %d' % i) for i in range(30)])
+        self.lib.redis.hdel(self.lib.database, *range(100, 130, 2))
+        cursors = [self.lib.sweep(count=4)]
+        while cursors[-1]:
+            cursors.append(self.lib.sweep(cursors[-1], count=4))
+        self.assertTrue(any(cursor and cursor[2] for cursor in cursors))
+        self.assertEqual(sorted(self.lib.retrieve(u'zzz')), list(range(101, 130, 2)))
+
+    def test_typeahead(self):
+        lib = self.lib
+        for keystrokes in (['b', 'bj', 'bjd', 'bjdx'], [u'北', u'北京', u'北京大'], ['qsing', 'qsing d', 'qsing da']):
+            for term in keystrokes:
+                self.assertEqual(lib.typeahead(term), lib.search(term))
+                self.assertEqual(lib.typeahead(term, t=0, limit=2), lib.search(term, t=0, limit=2))
+        self.assertGreater(lib.analyzer.stats()['queries']['hits'], 0)
+
+        for term in ['b', 'bj', 'bjd', 'bj d', 'bj dx']:
+            self.assertEqual(lib.typeahead(term, t=0, n__gte=4), lib.search(term, t=0, n__gte=4))
+        keys = set(lib.redis.keys('%s*' % lib.resultbase))
+        self.assertEqual(lib.typeahead(u'bjdx'), [item2, item6])
+        self.assertEqual(set(lib.redis.keys('%s*' % lib.resultbase)), keys)
+
+        self.assertEqual(lib.typeahead(u'bj', n=4), [item5, item2, item6])
+        previous = lib._result_key(('bj',), lib.dbs(dict(n=4)), lib.redis.get(lib.generation))
+        lib.redis.zrem(previous, item2['uid'])
+        self.assertEqual(lib.typeahead(u'bj d', previous=u'bj', n=4), [item6])
+        lib.redis.delete(previous)
+        self.assertEqual(lib.typeahead(u'bj da', previous=u'bj', n=4), [item2, item6])
+
+        self.assertTrue(lib._narrows(('qsing', 'd'), ('qsing',)))
+        self.assertFalse(lib._narrows(('bjd',), ('bj',)))
+        self.assertFalse(lib._narrows(('bj',), ('bj',)))
+        self.assertFalse(lib._narrows(('bj',), ()))
+
+    def test_typeahead_whole_term(self):
+        lib = self.lib
+        lib.add_item(dict(uid=13, term=u'peikinguniversal', t=0, n=4))
+        for term in ['peiking', 'peikingu', 'peikinguni', 'peikinguniv', 'peiking u', 'peiking univ']:
+            self.assertEqual(lib.typeahead(term, t=0), lib.search(term, t=0))
+            self.assertEqual(lib.typeahead(term, t=0, n__gte=1), lib.search(term, t=0, n__gte=1))
+        self.assertEqual([doc['uid'] for doc in lib.typeahead(u'peikinguniv', t=0)], [item4['uid'], 13])
+
+    def test_stats(self):
+        lib = self.lib
+        lib.redis.zadd('%s_0_qh' % lib.resultbase, {1: 1})
+        lib.redis.zadd('%s_tmp_x' % lib.resultbase, {1: 1})
+        lib.redis.zadd('%s_tmp_y' % lib.resultbase, {1: 1})
+        lib.redis.expire('%s_tmp_y' % lib.resultbase, 10)
+        stats = lib.stats(top=3, count=10)
+
+        contents = index_contents(lib)
+        zsets = dict((suffix, len(members)) for suffix, members in contents.items()
+                     if isinstance(members, list) and not suffix.endswith(b':range'))
+        self.assertEqual(stats['classes']['db']['keys'], 1)
+        self.assertEqual(stats['classes']['db']['members'], len(items))
+        self.assertEqual(stats['classes']['rev']['members'], len(items))
+        self.assertEqual(stats['classes']['idx']['keys'], len(zsets))
+        self.assertEqual(stats['classes']['idx']['members'], sum(zsets.values()))
+        self.assertEqual(stats['classes']['range']['keys'], 2)
+        self.assertEqual(stats['classes']['sets']['keys'], 3)
+        self.assertEqual(sum(prefix['keys'] for prefix in stats['prefixes'].values()), len(zsets))
+        self.assertEqual(stats['prefixes'][1]['max'],
+                         max(size for suffix, size in zsets.items() if len(suffix.decode()) == 2))
+        self.assertEqual([size for _, size in stats['largest']], sorted(zsets.values(), reverse=True)[:3])
+        self.assertEqual(stats['leaked']['keys'], 2)
+        self.assertEqual(stats['keys'], sum(kind['keys'] for kind in stats['classes'].values()))
+        memory = stats['classes']['db']['memory']
+        self.assertTrue(memory is None or memory > 0)
+
+    def test_update_item(self):
+        renamed = dict(uid=item2['uid'], term=u'北京师范大学', t=1, n=4)
+        self.lib.update_item(renamed)
+
+        self.assertNotIn(renamed['uid'], self.lib.retrieve(u'bjdx'))
+        self.assertNotIn(renamed['uid'], self.lib.retrieve(u'beijing', t=0))
+        self.assertIn(renamed['uid'], self.lib.retrieve(u'beijing', t=1))
+        self.assertIn(renamed['uid'], self.lib.retrieve(u'bjsf', t=1, n=4))
+        self.assertEqual(self.lib.search(u'bjsf'), [renamed])
+
+        fresh = Librorum(self.lib.redis, engine_name='fresh', structure=self.structure)
+        fresh.flush()
+        fresh.add_items(renamed if i is item2 else i for i in items)
+        self.assertEqual(index_contents(self.lib), index_contents(fresh))
+        fresh.flush()
+
+    def test_popularity(self):
+        lib = Librorum(self.lib.redis, engine_name='popular', structure=self.structure,
+                       hit_weight=1, hit_interval=None)
+        lib.flush()
+        lib.add_items(items)
+
+        def members():
+            return dict((key, set(m for m, _ in zset)) for key, zset in index_contents(lib).items()
+                        if isinstance(zset, list))
+
+        indexed = members()
+        self.assertSequenceEqual(lib.retrieve(u'bj'), [item5['uid'], item2['uid'], item6['uid']])
+
+        lib.record_hit(item6['uid'], 10)
+        lib.record_hit(item6['uid'], 10)
+        lib.record_hit(99)
+        self.assertSequenceEqual(lib.retrieve(u'bj'), [item5['uid'], item2['uid'], item6['uid']])
+        self.assertEqual(lib.flush_hits(), 21)
+        self.assertEqual(lib.flush_hits(), 0)
+        self.assertSequenceEqual(lib.retrieve(u'bj'), [item6['uid'], item5['uid'], item2['uid']])
+        self.assertSequenceEqual(lib.retrieve_scored(u'bjdx'), [(item2['uid'], 9.0), (item6['uid'], 16.75)])
+        self.assertFalse(lib.redis.hexists(lib.popularity, 99))
+        self.assertEqual(members(), indexed)
+
+        lib.update_item(dict(item6, t=1))
+        lib.add_item(item6)
+        self.assertSequenceEqual(lib.retrieve(u'bj'), [item6['uid'], item5['uid'], item2['uid']])
+        self.assertEqual(lib._reverse_entry(lib.redis.hget(lib.reverse, item6['uid']))[0]['bj'], 21.0)
+
+        lib.del_item(item6['uid'])
+        self.assertFalse(lib.redis.hexists(lib.popularity, item6['uid']))
+
+        # hit_interval=None only flushes by hand, a background flush needs its own interval
+        with self.assertRaises(Exception):
+            lib.flush_hits_in_background()
+        with self.assertRaises(Exception):
+            lib.flush_hits_in_background(0)
+        lib.record_hit(item5['uid'], 2)
+        lib.flush_hits_in_background(0.01).join(0.2)
+        self.assertEqual(lib.redis.hget(lib.popularity, item5['uid']), b'2')
+        lib.flush()
+
+    def test_versioned_rebuild(self):
+        lib = Librorum(self.lib.redis, engine_name='versioned', structure=self.structure,
+                       versioned=True, alias_ttl=0)
+        builder = lib.rebuild()
+        builder.add_items(items[:6])
+        lib.publish(builder)
+        self.assertEqual(lib.retrieve(u'bj', t=0), self.lib.retrieve(u'bj', t=0))
+
+        builder = lib.rebuild()
+        builder.add_items(items)
+        self.assertNotIn(item12['uid'], lib.retrieve(u'bd'))
+        lib.publish(builder)
+        self.assertIn(item12['uid'], lib.retrieve(u'bd'))
+
+        while lib.reclaim(count=10):
+            pass
+        self.assertEqual(lib.redis.keys('versioned_v1_*'), [])
+        self.assertEqual(lib.search(u'百度'), self.lib.search(u'百度'))
+
+        # publishing the live version again retires nothing, and the live version is never reclaimed
+        lib.publish(builder)
+        self.assertEqual(lib.redis.lindex(lib.retired, 0), None)
+        lib.redis.rpush(lib.retired, '%s:0' % builder.config['version'])
+        while lib.reclaim(count=10):
+            pass
+        self.assertEqual(lib.redis.lindex(lib.retired, 0), None)
+        self.assertIn(item12['uid'], lib.retrieve(u'bd'))
+
+        lib.flush()
+        self.assertEqual(lib.redis.keys('versioned_v2_*'), [])
+        lib.redis.delete(lib.alias, lib.versions)
+
+    def test_versioned_switch_during_call(self):
+        lib = Librorum(self.lib.redis, engine_name='pinned', structure=self.structure,
+                       versioned=True, alias_ttl=0)
+        first = lib.rebuild()
+        first.add_items(items)
+        lib.publish(first)
+        second = lib.rebuild()
+        second.add_items(dict(item, term=u'南京') for item in items)
+        expected = self.lib.search('b')
+
+        retrieve = lib.retrieve
+
+        def switch(*args, **kwargs):
+            uids = retrieve(*args, **kwargs)
+            lib.publish(second)
+            return uids
+        lib.retrieve = switch
+        self.assertEqual(lib.search('b'), expected)
+        del lib.retrieve
+        self.assertEqual(lib.search('b'), [])
+
+        lib.publish(first)
+        found = []
+        for item in lib.iter_search('b', chunk_size=2):
+            if not found:
+                lib.publish(second)
+            found.append(item)
+        self.assertEqual(found, expected)
+
+        for builder in (first, second):
+            builder.flush()
+        lib.redis.delete(lib.alias, lib.versions, lib.retired)
+
+    def test_bounded_prefixes(self):
+        lib = Librorum(self.lib.redis, engine_name='bounded', structure=self.structure,
+                       max_prefix=3, short_prefix=1, top_k=2)
+        lib.flush()
+        lib.add_items(items)
+
+        self.assertFalse(lib.redis.exists('%s_beij' % lib.indexbase))
+        self.assertEqual(lib.redis.zcard('%s_b' % lib.indexbase), 2)
+        self.assertEqual(lib.retrieve('b'), self.lib.retrieve('b')[:2])
+        for term in [u'beijing', u'beijingdaxue', u'qsinghua', u'北京大学', u'北京大学医学部']:
+            self.assertTrue(set(self.lib.retrieve(term)).issubset(lib.retrieve(term)))
+        self.assertSequenceEqual(lib.retrieve(u'北京大学医学部'), [item6['uid']])
+        # search converts to pinyin, the hanzi query is segmented first
+        self.assertEqual(lib.analyzer.search_term(u'北京大学医学部').split(' ')[0], 'bei')
+        self.assertEqual(lib.search(u'北京大学医学部'), [item6])
+        self.assertEqual(lib.typeahead(u'北京大学医学部'), [item6])
+        self.assertEqual(list(lib.iter_search(u'北京大学医学部')), [item6])
+        lib.flush()
+
+    def test_metrics(self):
+        sink = HistogramSink()
+        lib = Librorum(self.lib.redis, structure=self.structure, metrics=sink, planner=False)
+        self.assertEqual(lib.search(u'beijing', t=0), self.lib.search(u'beijing', t=0))
+        lib.add_item(dict(uid=13, term=u'呼和浩特', t=1))
+
+        snapshot = sink.snapshot()
+        for stage in ['search', 'search.pinyin', 'search.fetch', 'retrieve', 'retrieve.intersect',
+                      'add_item', 'get_indexes']:
+            self.assertEqual(snapshot['timings'][stage]['count'], 1)
+        self.assertEqual(snapshot['counts']['search.roundtrips']['max'], 2)
+        self.assertEqual(snapshot['counts']['retrieve.keys']['max'], 2)
+        self.assertEqual(snapshot['counts']['retrieve.cardinality']['max'], len(self.lib.retrieve(u'beijing', t=0)))
+        self.assertEqual(snapshot['counts']['add_item.roundtrips']['max'], 2)
+
+        scripted = Librorum(self.lib.redis, structure=self.structure, metrics=HistogramSink(), scripted=True)
+        self.assertEqual(hasattr(scripted.redis, 'register_script'), hasattr(self.lib.redis, 'register_script'))
+        self.assertEqual(scripted.search('b'), self.lib.search('b'))
+
+    def test_planner(self):
+        lib = Librorum(self.lib.redis, structure=self.structure, planner=False)
+        planned = Librorum(self.lib.redis, structure=self.structure, probe_limit=64)
+        for term in ['b', 'q', 'bj', u'daxue', u'百度', u'qsing daxue', u'nothing', u'b nothing']:
+            for filters in [{}, dict(t=0), dict(t=1), dict(n=4), dict(t=0, n=4), dict(t=3)]:
+                for limit, offset in [(0, 0), (2, 0), (0, 1), (3, 1)]:
+                    self.assertSequenceEqual(planned.retrieve(term, limit, offset, **filters),
+                                             lib.retrieve(term, limit, offset, **filters))
+
+        popular = Librorum(self.lib.redis, structure=self.structure, hit_weight=1, hit_interval=None)
+        popular.record_hit(item5['uid'], 3)
+        popular.flush_hits()
+        self.assertEqual(planned.retrieve_scored('bj', t=0)[0], (item5['uid'], 1.0))
+        self.assertSequenceEqual(planned.retrieve('bj', t=0), lib.retrieve('bj', t=0))
+
+        class OldBackend(MemoryBackend):
+            """ A server before Redis 6.2 """
+            def smismember(self, *args):
+                raise Exception("unknown command 'SMISMEMBER'")
+
+            zmscore = smismember
+
+        old = Librorum(OldBackend(), structure=self.structure)
+        old.add_items(items)
+        self.assertEqual(old.retrieve('q', t=1, n=4), lib.retrieve('q', t=1, n=4))
+        self.assertFalse(old._probes)
+        self.assertEqual(old.retrieve('b', t=0, limit=2), lib.retrieve('b', t=0, limit=2))
+
+        bounded = Librorum(self.lib.redis, structure=self.structure, cache_size=2)
+        for term in ['b', 'q', 'bj', u'daxue']:
+            bounded.retrieve(term, t=0)
+        self.assertEqual(bounded._cardinalities.stats()['size'], 2)
+
+    def test_codecs(self):
+        codecs = ['json', 'table'] + (['msgpack'] if msgpack else [])
+        for codec in codecs:
+            lib = Librorum(self.connect(), engine_name='codec', structure=self.structure, codec=codec)
+            lib.flush()
+            lib.add_items(items)
+            for term, kwargs in [(u'beijing', {}), (u'北京', dict(t=0)), ('b', dict(limit=LIMIT))]:
+                self.assertEqual(lib.search(term, **kwargs), self.lib.search(term, **kwargs))
+                projected = [dict(uid=item['uid'], term=item['term']) for item in self.lib.search(term, **kwargs)]
+                self.assertEqual(lib.search(term, fields=['uid', 'term'], **kwargs), projected)
+            lib.flush()
+
+    def test_convert_database(self):
+        expected = self.lib.search('b')
+        lib = Librorum(self.lib.redis, structure=self.structure, codec='table')
+        self.assertEqual(lib.convert_database('json', count=5), len(items))
+        self.assertEqual(lib.search('b'), expected)
+        self.assertEqual(lib.search('b', fields=['n']), [dict((k, v) for k, v in item.items() if k == 'n')
+                                                         for item in expected])
+        self.assertEqual(lib.convert_database('json'), 0)
+
+    def test_mixed_database(self):
+        expected = self.lib.search('b')
+        codecs = ['json', 'table'] + (['msgpack'] if msgpack else [])
+        for i, item in enumerate(items):
+            codec = self.lib.make_codec(codecs[i % len(codecs)])
+            self.lib.redis.hset(self.lib.database, item['uid'], codec.encode(item))
+        for codec in codecs:
+            lib = Librorum(self.lib.redis, structure=self.structure, codec=codec)
+            self.assertEqual(lib.search('b'), expected)
+            self.assertEqual(lib.search('b', fields=['uid']), [dict(uid=item['uid']) for item in expected])
+
+        lib = Librorum(self.lib.redis, structure=self.structure, codec='table')
+        self.assertEqual(lib.convert_database('json'), len(items[::len(codecs)]))
+        self.assertEqual(lib.search('b'), expected)
+        self.assertEqual(lib.convert_database(), len(items[2::3]) if msgpack else 0)
+        self.assertEqual(lib.convert_database(), 0)
+        self.assertEqual(lib.search('b'), expected)
+        self.assertTrue(all(raw.startswith(b'[') for _, raw in lib.redis.hscan_iter(lib.database)))
+
+    def test_snapshot(self):
+        fd, path = tempfile.mkstemp(suffix='.snapshot')
+        os.close(fd)
+        stats = snapshot.build(items, path, batch_size=5, structure=self.structure)
+        self.assertGreater(stats['keys'], 0)
+
+        lib = Librorum(self.connect(), engine_name='snapshot', structure=self.structure)
+        self.assertEqual(snapshot.restore(lib, path)['entries'], stats['entries'])
+        versioned = Librorum(self.connect(), engine_name='snapshot', structure=self.structure, versioned=True)
+        builder = versioned.rebuild()
+        snapshot.restore(builder, path)
+        versioned.publish(builder)
+        for term, kwargs in [('b', {}), (u'北京', dict(t=0)), ('q', dict(n__gte=4)), ('b', dict(limit=LIMIT))]:
+            self.assertEqual(lib.search(term, **kwargs), self.lib.search(term, **kwargs))
+            self.assertEqual(versioned.search(term, **kwargs), self.lib.search(term, **kwargs))
+
+        lib.update_item(dict(item5, term=u'南京'))
+        self.assertEqual(lib.retrieve('nj'), [5])
+        with self.assertRaises(Exception):
+            snapshot.restore(Librorum(self.connect(), codec='table'), path)
+        for config in [dict(structure=dict(t=int, x=int)), dict(structure=self.structure, max_prefix=3)]:
+            with self.assertRaises(Exception):
+                snapshot.restore(Librorum(self.connect(), engine_name='other', **config), path)
+        snapshot.build(items, path, structure=self.structure, codec='table')
+        with self.assertRaises(Exception):
+            snapshot.restore(Librorum(self.connect(), engine_name='other', structure=self.structure, codec='table',
+                                      table_fields=['uid', 'term', 't', 'n']), path)
+        lib.flush()
+        versioned.flush()
+        os.remove(path)
+
     def test_flush(self):
-        assert self.lib.redis.exists(self.lib.database) is True
+        assert self.lib.redis.exists(self.lib.database)
         self.lib.flush()
 
         assert len(self.lib.retrieve('b')) is 0
         assert len(self.lib.retrieve('q')) is 0
-        assert self.lib.redis.exists(self.lib.database) is False
+        assert not self.lib.redis.exists(self.lib.database)
+
+
+class TestMemoryEngine(TestEngine):
+    """ The engine tests, against the in-process backend """
+
+    def connect(self):
+        return MemoryBackend()
+
+
+class TestShardedEngine(unittest.TestCase):
+    def setUp(self):
+        self.structure = dict(t=int, n=int)
+        self.lib = Librorum(MemoryBackend(), structure=self.structure)
+        self.lib.add_items(items)
+        self.sharded = ShardedLibrorum([MemoryBackend() for _ in range(3)], structure=self.structure)
+        self.sharded.add_items(items, batch_size=5)
+
+    def test_partition(self):
+        sizes = [shard.redis.hlen(shard.database) for shard in self.sharded.shards]
+        self.assertEqual(sum(sizes), len(items))
+        self.assertGreater(min(sizes), 0)
+        for i, shard in enumerate(self.sharded.shards):
+            self.assertTrue(all(key.startswith(('{:%d}_' % i).encode()) for key in shard.redis.keys()))
+
+    def test_retrieve(self):
+        for term in ['b', 'q', 'bj', u'daxue', u'百度', u'nothing']:
+            for filters in [{}, dict(t=0), dict(n=4), dict(n__gte=4)]:
+                for limit, offset in [(0, 0), (2, 0), (0, 1), (3, 1), (5, 2), (0, -2), (-1, 0)]:
+                    self.assertEqual(self.sharded.retrieve_scored(term, limit, offset, **filters),
+                                     self.lib.retrieve_scored(term, limit, offset, **filters))
+
+    def test_search(self):
+        for term, kwargs in [(u'beijing', {}), (u'北京', dict(t=0)), ('b', dict(limit=LIMIT)),
+                             ('b', dict(limit=4, offset=1, fields=['term'])), ('zzz', {})]:
+            self.assertEqual(self.sharded.search(term, **kwargs), self.lib.search(term, **kwargs))
+        self.assertEqual(self.sharded.search_many(['b', dict(term='q', t=1)]),
+                         [self.lib.search('b'), self.lib.search('q', t=1)])
+
+    def test_writes(self):
+        self.sharded.update_item(dict(item5, term=u'南京'))
+        self.lib.update_item(dict(item5, term=u'南京'))
+        self.sharded.del_items([2, 3, 4])
+        self.lib.del_items([2, 3, 4])
+        self.sharded.add_item(dict(uid=13, term=u'北京交通大学', t=0))
+        self.lib.add_item(dict(uid=13, term=u'北京交通大学', t=0))
+        for term in ['b', 'nj', 'q', u'交通']:
+            self.assertEqual(self.sharded.search(term), self.lib.search(term))
+        shard = self.sharded.shard(13)
+        shard.redis.hdel(shard.database, 13)
+        self.assertEqual(self.sharded.search(u'交通'), [])
+
+        self.sharded.flush()
+        self.assertEqual(self.sharded.retrieve('b'), [])
+
+    def test_add_items_workers(self):
+        self.sharded.flush()
+        stats = self.sharded.add_items(items, batch_size=4, workers=2)
+        self.assertEqual(sum(batch['items'] for batch in stats), len(items))
+        for term in ['b', 'q', u'百度', 'bjdx']:
+            self.assertEqual(self.sharded.retrieve_scored(term), self.lib.retrieve_scored(term))
+
+
+class TestLoader(unittest.TestCase):
+    def setUp(self):
+        self.structure = dict(t=int, n=int)
+        self.expected = Librorum(MemoryBackend(), structure=self.structure)
+        self.expected.add_items(items)
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'items.jsonl')
+        with open(self.path, 'w', encoding='utf-8') as f:
+            for item in items:
+                f.write(json.dumps(item, ensure_ascii=False) + '\n\n')
+
+    def tearDown(self):
+        for name in os.listdir(self.directory):
+            os.remove(os.path.join(self.directory, name))
+        os.rmdir(self.directory)
+
+    def assertLoaded(self, lib):
+        for term in ['b', 'q', u'北京', u'百度']:
+            self.assertEqual(lib.search(term), self.expected.search(term))
+
+    def test_load(self):
+        lib = Librorum(MemoryBackend(), structure=self.structure)
+        stats = load(lib, self.path, batch_size=5, queue_size=1)
+        self.assertEqual(stats['items'], len(items))
+        self.assertEqual(stats['offset'], os.path.getsize(self.path))
+        self.assertLoaded(lib)
+        self.assertFalse(os.path.exists(self.path + '.checkpoint'))
+
+    def test_resume(self):
+        class Crash(Exception):
+            pass
+
+        lib = Librorum(MemoryBackend(), structure=self.structure)
+        write_batch = lib._write_batch
+
+        def crashing(batch, indexes=None):
+            if lib.redis.hlen(lib.database) >= 6:
+                raise Crash()
+            write_batch(batch, indexes)
+        lib._write_batch = crashing
+        with self.assertRaises(Crash):
+            load(lib, self.path, batch_size=3, checkpoint_every=1)
+        self.assertEqual(lib.redis.hlen(lib.database), 6)
+
+        lib._write_batch = write_batch
+        stats = load(lib, self.path, batch_size=3)
+        self.assertEqual(stats['items'], len(items) - 6)
+        self.assertLoaded(lib)
+
+    def test_versioned_switch_during_batch(self):
+        lib = Librorum(MemoryBackend(), engine_name='e', structure=self.structure, versioned=True, alias_ttl=0)
+        lib.publish(lib.rebuild())
+        collect = lib._collect
+
+        def switching(*args):
+            batch = collect(*args)
+            lib.publish(lib.rebuild())
+            return batch
+        lib._collect = switching
+        load(lib, self.path, batch_size=3)
+        # every batch is written whole to the version that was live when it started
+        for version in set(key.split(b'_')[1] for key in lib.redis.keys('e_v*')):
+            prefix = b'e_' + version
+            docs = set(uid for uid, _ in lib.redis.hscan_iter(prefix + b'_db'))
+            indexed = set()
+            for key in lib.redis.keys(prefix + b'_idx_*'):
+                indexed.update(lib.redis.zrange(key, 0, -1) if lib.redis.type(key) == b'zset'
+                               else lib.redis.smembers(key))
+            self.assertEqual(docs, indexed)
+
+    def test_bad_line(self):
+        size = os.path.getsize(self.path)
+        with open(self.path, 'a') as f:
+            f.write('{"uid": 13, \n')
+        lib = Librorum(MemoryBackend(), structure=self.structure)
+        with self.assertRaises(ValueError):
+            load(lib, self.path, batch_size=5)
+        self.assertEqual(lib.redis.hlen(lib.database), 10)
+
+        with open(self.path, 'r+') as f:
+            f.truncate(size)
+        self.assertEqual(load(lib, self.path, batch_size=5)['items'], 2)
+        self.assertLoaded(lib)
+
+
+class TestAsyncEngine(unittest.TestCase):
+    def setUp(self):
+        self.structure = dict(t=int, n=int)
+        self.lib = Librorum(redis.StrictRedis(), structure=self.structure)
+        self.lib.flush()
+        self.lib.add_items(items)
+
+    def run_with_engine(self, test, **kwargs):
+        async def run():
+            return await test(AsyncLibrorum(redis.asyncio.StrictRedis(), structure=self.structure, **kwargs))
+        return asyncio.run(run())
+
+    def test_search(self):
+        async def test(lib):
+            self.assertEqual(await lib.retrieve(u'bj', t=0), self.lib.retrieve(u'bj', t=0))
+            self.assertEqual(await lib.search(u'百度', limit=LIMIT), self.lib.search(u'百度', limit=LIMIT))
+            self.assertEqual(await lib.search('b', t__gte=1), self.lib.search('b', t=1))
+            results = await lib.search_many([u'beijing', dict(term=u'qh', t=1), dict(term='b', limit=2)])
+            self.assertEqual(results, [self.lib.search(u'beijing'), self.lib.search(u'qh', t=1),
+                                       self.lib.search('b', limit=2)])
+
+        self.run_with_engine(test)
+        self.run_with_engine(test, cached=True)
+        self.run_with_engine(test, scripted=True)
+
+    def test_add_item_and_flush(self):
+        async def test(lib):
+            await lib.add_item(dict(uid=13, term=u'呼和浩特', t=1))
+            self.assertEqual(self.lib.retrieve(u'hhht', t=1), [13])
+            self.lib.del_item(13)
+            self.assertEqual(await lib.retrieve(u'hhht'), [])
+
+            await lib.flush()
+            self.assertFalse(self.lib.redis.exists(self.lib.database))
+            self.assertEqual(self.lib.retrieve('b'), [])
+
+        self.run_with_engine(test)
+
+    def test_versioned(self):
+        sync = Librorum(self.lib.redis, engine_name='versioned', structure=self.structure,
+                        versioned=True, alias_ttl=0)
+        builder = sync.rebuild()
+        builder.add_items(items[:6])
+        sync.publish(builder)
+
+        async def test(lib):
+            self.assertEqual(await lib.search(u'北京'), sync.search(u'北京'))
+            # the tokenizer runs in the executor with the namespace pinned by the call
+            token = lib._pinned.set('versioned_v0')
+            try:
+                self.assertEqual(await lib._run(lambda: lib.namespace), 'versioned_v0')
+            finally:
+                lib._pinned.reset(token)
+            await lib.add_item(dict(uid=13, term=u'呼和浩特', t=1))
+            self.assertEqual(sync.retrieve(u'hhht', t=1), [13])
+
+        try:
+            self.run_with_engine(test, engine_name='versioned', versioned=True, alias_ttl=0)
+        finally:
+            sync.flush()
+            sync.redis.delete(sync.alias, sync.versions, sync.retired)
+
+    def test_del_item_and_hits(self):
+        async def test(lib):
+            await lib.record_hit(item5['uid'], 3)
+            self.assertEqual(await lib.flush_hits(), 3)
+            self.assertEqual(self.lib.redis.hget(self.lib.popularity, item5['uid']), b'3')
+            self.assertEqual(await lib.retrieve('bj', t=0), self.lib.retrieve('bj', t=0))
+
+            await lib.del_item(item5['uid'])
+            self.assertNotIn(item5['uid'], self.lib.retrieve('b'))
+            self.assertIsNone(self.lib.redis.hget(self.lib.reverse, item5['uid']))
+            for name in ['update_item', 'typeahead', 'stats', 'iter_search', 'rebuild']:
+                self.assertFalse(hasattr(lib, name))
+
+        self.run_with_engine(test, hit_weight=1, hit_interval=None)
 
 
 if __name__ == '__main__':